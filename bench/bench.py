@@ -0,0 +1,224 @@
+'''
+読み上げ処理のベンチマーク（Discordに接続せずに実行する）
+
+使い方:
+    python bench/bench.py                 # 計測して結果を表示
+    python bench/bench.py --save          # 結果をベースラインとして保存
+    python bench/bench.py --compare       # ベースラインと比較（遅くなっていたら終了コード1）
+    python bench/bench.py --real          # 実際の音声合成バックエンドで計測
+'''
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+BENCH_DIR = ROOT / 'bench'
+sys.path.insert(0, str(ROOT))
+os.chdir(str(ROOT))
+# NOTE: voice_utilの読み込みに必要なので、未設定なら仮の値を入れる
+os.environ.setdefault('DIC_DIR', tempfile.gettempdir())
+os.environ.setdefault('SYS_VOICE_DIR', tempfile.gettempdir())
+
+from cogs.utils.file_cache import FileCache  # noqa: E402
+from cogs.utils.msg_util import MessageConverter  # noqa: E402
+from cogs.utils.sound_matcher import SoundMatcher  # noqa: E402
+from cogs.utils.synth_backend import Pcm  # noqa: E402
+from cogs.utils.voice_util import VoiceFactory  # noqa: E402
+from cogs.voice_reading import VoiceReading  # noqa: E402
+from setting import SettingStore, UserSetting  # noqa: E402
+
+
+class MemoryBackend():
+    '''ファイルに書き込まない設定の保存先'''
+
+    def __init__(self, data: dict):
+        self.data = data
+
+    def load(self) -> dict:
+        return self.data
+
+    def version(self) -> int:
+        return 0
+
+    def save(self, data: dict, keys: set, version) -> tuple:
+        return (data, 0)
+
+
+class StubBackend():
+    '''文字数に応じた無音を返す音声合成のスタブ'''
+    queue_depth = 0
+    running = 0
+    size = 1
+
+    async def synthesize(self, text: str, voice_path: Path, setting: dict) -> Pcm:
+        # 1文字0.15秒、48kHz 16bitモノラル
+        return Pcm(b'\x00\x00' * int(48000 * 0.15 * len(text)), 48000)
+
+
+def load_corpus() -> list:
+    with (BENCH_DIR / 'corpus.txt').open() as f:
+        return [line.rstrip('\n') for line in f if line.strip()]
+
+
+def load_sounds() -> list:
+    '''リポジトリのサウンド定義に架空のサウンドを足して約100件にする'''
+    with (ROOT / 'data/json/sound_links.json').open() as f:
+        data = json.loads(f.read())
+    sounds = [{'id': str(i + 1), 'name': v['name'], 'reg': reg, 'links': v['link']}
+              for i, (reg, v) in enumerate(data.items())]
+    for i in range(len(sounds), 100):
+        sounds.append({'id': str(i + 1), 'name': f'sound{i}',
+                       'reg': f'(さうんど|サウンド){i}(！|!)?',
+                       'links': f'https://example.com/sound{i}.mp3'})
+    return sounds
+
+
+def setup(tmp: Path) -> VoiceReading:
+    '''Discordやデプロイ先のファイルなしで動くように準備する'''
+    # ユーザー辞書
+    words_file = tmp / 'words.json'
+    words = {'草': 'くさ', 'おつ': 'おつかれ', 'VC': 'ボイスチャット'}
+    words.update({f'単語{i}': f'たんご{i}' for i in range(2000)})
+    with words_file.open('w') as f:
+        f.write(json.dumps(words, ensure_ascii=False))
+    VoiceReading.WORDS_FILE = words_file
+
+    # サウンド
+    sounds_file = tmp / 'sound_links.json'
+    with sounds_file.open('w') as f:
+        f.write(json.dumps(load_sounds(), ensure_ascii=False))
+    VoiceFactory._sound_matcher = FileCache(sounds_file, SoundMatcher.load)
+
+    # ユーザー設定
+    with (ROOT / 'settings/user_setting.json.sample').open() as f:
+        UserSetting._store = SettingStore(MemoryBackend(json.loads(f.read())))
+
+    return VoiceReading(None)
+
+
+def measure(name: str, func, corpus: list, repeat: int) -> dict:
+    '''コーパスの各行でfuncを実行した時間を計測する'''
+    samples = []
+    for _ in range(repeat):
+        for line in corpus:
+            start = time.perf_counter()
+            func(line)
+            samples.append(time.perf_counter() - start)
+    samples.sort()
+    total = sum(samples)
+    return {
+        'name': name,
+        'count': len(samples),
+        'ops_per_sec': len(samples) / total if total > 0 else 0.0,
+        'p50_us': samples[len(samples) // 2] * 1e6,
+        'p99_us': samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1e6,
+        'mean_us': statistics.mean(samples) * 1e6,
+    }
+
+
+def measure_async(name: str, func, corpus: list, repeat: int) -> dict:
+    loop = asyncio.new_event_loop()
+    try:
+        return measure(
+            name, lambda line: loop.run_until_complete(func(line)),
+            corpus, repeat)
+    finally:
+        loop.close()
+
+
+def run(repeat: int, real: bool) -> list:
+    corpus = load_corpus()
+    with tempfile.TemporaryDirectory() as tmp:
+        cog = setup(Path(tmp))
+        long_corpus = [line * 50 for line in corpus[:10]]
+        converted = [cog._convert_message(line, cog.read_char_cnt)
+                     for line in corpus]
+        matcher = VoiceFactory._sound_matcher.get()
+
+        if real is False:
+            VoiceFactory._backend = StubBackend()
+        backend = VoiceFactory.get_backend()
+        setting = VoiceFactory.get_user_setting(0)
+        voice_file = VoiceFactory.get_voice_list()[setting['voice']] if real else 'stub'
+        voice_path = VoiceFactory.SYS_VOICE_DIR / f'{voice_file}.htsvoice'
+
+        results = [
+            measure('regex', MessageConverter.replace_by_re, corpus, repeat),
+            measure('words', lambda m: cog.words.get().replace(m), corpus, repeat),
+            measure('eng_kana', MessageConverter.replace_eng_to_kana, corpus, repeat),
+            measure('roman_kana', MessageConverter.replace_roman_to_kana, corpus, repeat),
+            measure('convert_message',
+                    lambda m: cog._convert_message(m, cog.read_char_cnt),
+                    corpus, repeat),
+            measure('convert_long_paste',
+                    lambda m: cog._convert_message(m, cog.read_char_cnt),
+                    long_corpus, repeat),
+            measure('sound_match', matcher.match, converted, repeat),
+            measure_async(
+                'synthesize',
+                lambda m: backend.synthesize(m, voice_path, setting),
+                converted, 1 if real else repeat),
+        ]
+    return results
+
+
+def print_results(results: list, baseline: dict = None) -> None:
+    print(f"{'stage':<20}{'ops/s':>12}{'p50(us)':>12}{'p99(us)':>12}{'vs base':>10}")
+    for r in results:
+        diff = ''
+        if baseline is not None and r['name'] in baseline:
+            base = baseline[r['name']]['p50_us']
+            if base > 0:
+                diff = f"{(r['p50_us'] / base - 1) * 100:+.0f}%"
+        print(f"{r['name']:<20}{r['ops_per_sec']:>12.0f}"
+              f"{r['p50_us']:>12.1f}{r['p99_us']:>12.1f}{diff:>10}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='読み上げ処理のベンチマーク')
+    parser.add_argument('-n', '--repeat', type=int, default=20,
+                        help='コーパスを繰り返す回数')
+    parser.add_argument('--real', action='store_true',
+                        help='実際の音声合成バックエンドを使う')
+    parser.add_argument('--baseline', type=Path,
+                        default=BENCH_DIR / 'baseline.json',
+                        help='ベースラインのファイル')
+    parser.add_argument('--save', action='store_true',
+                        help='結果をベースラインとして保存する')
+    parser.add_argument('--compare', action='store_true',
+                        help='ベースラインより遅くなっていたら終了コード1にする')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='遅くなったと判定するp50の増加率')
+    args = parser.parse_args()
+
+    results = run(args.repeat, args.real)
+
+    baseline = None
+    if args.baseline.exists():
+        with args.baseline.open() as f:
+            baseline = json.loads(f.read())
+    print_results(results, baseline)
+
+    if args.save:
+        with args.baseline.open('w') as f:
+            f.write(json.dumps({r['name']: r for r in results}, indent=4))
+        print(f'saved: {args.baseline}')
+
+    if args.compare and baseline is not None:
+        regressed = [r['name'] for r in results
+                     if r['name'] in baseline and
+                     r['p50_us'] > baseline[r['name']]['p50_us'] * (1 + args.threshold)]
+        if len(regressed) > 0:
+            print(f"regressed: {', '.join(regressed)}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
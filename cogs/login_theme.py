@@ -1,4 +1,3 @@
-import asyncio
 import re
 
 from discord.ext import commands
@@ -6,6 +5,7 @@ import discord
 
 from setting import UserSetting
 from cogs.utils.voice_util import VoiceFactory
+from cogs.utils.session import SessionStore
 
 
 class LoginTheme(commands.Cog):
@@ -30,32 +30,24 @@ class LoginTheme(commands.Cog):
         if before.channel is not None:
             return
 
-        guild = self.bot.get_guild(member.guild.id)
-        if guild is None:
-            return None
-        vc = guild.voice_client
-        if vc is None:
+        session = SessionStore.get(member.guild.id)
+        if session is None or session.queue is None:
             return
+        vc = session.voice_client
 
         # botが参加していないVoiceChannelでのステータス変更なら無視
         if after.channel != vc.channel:
             return
 
-        # 音声ファイルを取得する
-        vf = await self.__fetch_user_theme(member.id, member.guild.id)
-        if vf is None:
+        # テーマが設定されていなければ無視
+        url = self.__get_user_theme(member.id, member.guild.id)
+        if url is None:
             return
 
-        for _ in range(600):
-            try:
-                vc.play(
-                    discord.FFmpegPCMAudio(str(vf)),
-                    after=lambda e: vf.unlink())
-                break
-            except discord.ClientException:
-                await asyncio.sleep(0.2)
-        else:
-            vf.unlink()
+        # NOTE: 音声ファイルの取得は再生キューが先読みで行なう
+        session.queue.put(
+            lambda: VoiceFactory.create_voice_from_url(url),
+            f'theme: {member.display_name}')
 
     @commands.group(aliases=['th'])
     async def theme(self, ctx):
@@ -118,12 +110,6 @@ class LoginTheme(commands.Cog):
             return None
         return data["theme"].get(str(guild_id), None)
 
-    async def __fetch_user_theme(self, user_id: int, guild_id: int):
-        data = self.__get_user_theme(user_id, guild_id)
-        if data is None:
-            return None
-        return await VoiceFactory.create_voice_from_url(data)
-
 
 def setup(bot):
     bot.add_cog(LoginTheme(bot))
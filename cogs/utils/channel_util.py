@@ -0,0 +1,47 @@
+import time
+
+import discord
+
+
+class ChannelResolver():
+    '''
+    チャンネルIDからチャンネルを取得する
+    ゲートウェイのキャッシュを優先し、なければAPIで取得する
+    存在しなかったチャンネルはnegative_ttl秒の間は再取得しない
+    '''
+
+    def __init__(self, bot, negative_ttl: float = 10 * 60):
+        self.bot = bot
+        self.negative_ttl = negative_ttl
+        # 存在しなかったチャンネルID→確認した時刻
+        self._missing = {}
+
+    def is_missing(self, channel_id: int) -> bool:
+        '''存在しないことが分かっているチャンネルかどうか'''
+        checked_at = self._missing.get(channel_id)
+        if checked_at is None:
+            return False
+        if time.monotonic() - checked_at > self.negative_ttl:
+            del self._missing[channel_id]
+            return False
+        return True
+
+    async def resolve(self, channel_id: int):
+        '''
+        チャンネルを取得する（取得できなければNone）
+        存在しないのか一時的なエラーなのかはis_missingで判定する
+        '''
+        channel = self.bot.get_channel(channel_id)
+        if channel is not None:
+            return channel
+        if self.is_missing(channel_id):
+            return None
+
+        try:
+            return await self.bot.fetch_channel(channel_id)
+        except (discord.NotFound, discord.Forbidden):
+            self._missing[channel_id] = time.monotonic()
+            return None
+        except discord.HTTPException:
+            # NOTE: 一時的なエラーの可能性があるので覚えない
+            return None
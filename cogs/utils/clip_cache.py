@@ -0,0 +1,126 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+
+import aiohttp
+
+from .file_cache import evict_lru, touch, write_atomic
+from .http_util import HttpClient
+from .metrics import Metrics
+
+
+class ClipCache():
+    '''
+    URLをキーにした音声ファイルのディスクキャッシュ
+    合計サイズがmax_bytesを超えたら使われていない順に削除する
+    '''
+
+    def __init__(
+            self, directory: Path,
+            max_bytes: int = 512 * 1024 * 1024,
+            revalidate_after: float = 24 * 60 * 60):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # 最後の確認からこの秒数が経ったらETag/Last-Modifiedで更新を確認する
+        self.revalidate_after = revalidate_after
+        # ダウンロード中のURL→タスク
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+        # 取得に失敗したURL→理由
+        self.errors = {}
+
+    def _paths(self, url: str) -> tuple:
+        '''URLに対応する (音声ファイル, メタデータ) のパス'''
+        key = hashlib.sha256(url.encode()).hexdigest()
+        _, ext = os.path.splitext(url.split('?')[0])
+        return (self.directory / f'{key}{ext}', self.directory / f'{key}.json')
+
+    def path_for(self, url: str) -> Path:
+        '''キャッシュ済みならファイルのパスを返す（なければNone）'''
+        path, _ = self._paths(url)
+        return path if path.exists() else None
+
+    async def get(self, url: str, force: bool = False) -> Path:
+        '''
+        URLの音声ファイルを取得する（取得できなければNone）
+        同じURLを同時に取得する場合はダウンロードを共有する
+        forceがTrueなら確認の期限内でもサーバーに更新を確認する
+        '''
+        key = (url, force)
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(url, force))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _fetch(self, url: str, force: bool = False) -> Path:
+        path, meta_path = self._paths(url)
+        meta = {}
+        if path.exists() and meta_path.exists():
+            with meta_path.open() as f:
+                meta = json.loads(f.read())
+            if force is False and \
+                    time.time() - meta.get('checked_at', 0) < self.revalidate_after:
+                self.hits += 1
+                Metrics.inc('cache', 'clip', 'hit')
+                touch(path)
+                return path
+
+        headers = {}
+        if 'etag' in meta:
+            headers['If-None-Match'] = meta['etag']
+        if 'last_modified' in meta:
+            headers['If-Modified-Since'] = meta['last_modified']
+
+        try:
+            session = HttpClient.get_session()
+            start = time.perf_counter()
+            async with session.get(url, headers=headers) as r:
+                if r.status == 304:
+                    self.hits += 1
+                    Metrics.inc('cache', 'clip', 'revalidated')
+                elif r.status == 200:
+                    self.misses += 1
+                    Metrics.inc('cache', 'clip', 'miss')
+                    self.directory.mkdir(parents=True, exist_ok=True)
+                    data = await r.read()
+                    Metrics.observe('download', time.perf_counter() - start)
+                    write_atomic(path, data)
+                    # 元のファイルから変換したファイルは作り直す
+                    for p in self.directory.glob(f"{path.name.split('.')[0]}.*"):
+                        if p not in (path, meta_path):
+                            p.unlink()
+                    meta = {'url': url}
+                    if 'ETag' in r.headers:
+                        meta['etag'] = r.headers['ETag']
+                    if 'Last-Modified' in r.headers:
+                        meta['last_modified'] = r.headers['Last-Modified']
+                else:
+                    # NOTE: 取得に失敗しても古いファイルがあればそれを使う
+                    print(f'Download failed ({r.status}) : {url}')
+                    self.errors[url] = f'HTTP {r.status}'
+                    return path if path.exists() else None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f'Download failed ({e}) : {url}')
+            self.errors[url] = str(e) or type(e).__name__
+            return path if path.exists() else None
+
+        self.errors.pop(url, None)
+
+        meta['checked_at'] = time.time()
+        write_atomic(meta_path, json.dumps(meta))
+        touch(path)
+        # 合計サイズが上限を超えていたら古いものから削除する
+        for p in evict_lru(self.directory, self.max_bytes, ('.json',)):
+            meta = p.with_suffix('.json')
+            if meta.exists():
+                try:
+                    meta.unlink()
+                except FileNotFoundError:
+                    pass
+        return path
@@ -0,0 +1,121 @@
+import os
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:
+    # NOTE: Windowsではプロセス間のロックをしない
+    fcntl = None
+
+
+def write_atomic(path: Path, data) -> None:
+    '''
+    ファイルを書き込む（dataはstrかbytes）
+    書き込み途中で落ちても壊れないように一時ファイルを置き換える
+    '''
+    fd, tmp = tempfile.mkstemp(dir=str(path.parent), prefix=f'.{path.name}.')
+    try:
+        with os.fdopen(fd, 'wb' if isinstance(data, bytes) else 'w') as f:
+            f.write(data)
+        os.replace(tmp, str(path))
+    except Exception:
+        os.unlink(tmp)
+        raise
+
+
+@contextmanager
+def file_lock(path: Path):
+    '''
+    プロセス間でファイルの読み書きを排他する
+    pathの隣にロック用のファイルを作成する
+    '''
+    if fcntl is None:
+        yield
+        return
+    lock_path = path.with_name(f'.{path.name}.lock')
+    with open(str(lock_path), 'a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def evict_lru(directory: Path, max_bytes: int, ignore_suffixes=()) -> list:
+    '''
+    ディレクトリ内の合計サイズが上限を超えていたら、
+    更新時刻（最終使用時刻）が古いファイルから削除して削除したパスを返す
+    '''
+    files = []
+    total = 0
+    for p in directory.iterdir():
+        if p.suffix in ignore_suffixes or p.name.startswith('.'):
+            continue
+        # NOTE: 他のプロセスが先に削除している場合がある
+        try:
+            st = p.stat()
+        except FileNotFoundError:
+            continue
+        files.append((st.st_mtime, st.st_size, p))
+        total += st.st_size
+
+    removed = []
+    files.sort()
+    for _, size, p in files:
+        if total <= max_bytes:
+            break
+        try:
+            p.unlink()
+        except FileNotFoundError:
+            pass
+        removed.append(p)
+        total -= size
+    return removed
+
+
+def touch(path: Path) -> None:
+    '''更新時刻を現在時刻にする（最終使用時刻として扱う）'''
+    try:
+        os.utime(str(path))
+    except FileNotFoundError:
+        pass
+
+
+class FileCache():
+    '''
+    ファイルを読み込んだ結果を保持するキャッシュ
+    ファイルの更新時刻が変わった時だけloaderで読み直す
+    '''
+
+    def __init__(self, path: Path, loader):
+        self.path = path
+        # Pathを受け取って読み込んだ結果を返す関数
+        self.loader = loader
+        self._mtime = None
+        self._value = None
+
+    def get(self):
+        '''読み込み済みの値を取得する（ファイルが更新されていたら読み直す）'''
+        try:
+            mtime = os.stat(str(self.path)).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if self._value is None or mtime != self._mtime:
+            self._value = self.loader(self.path)
+            self._mtime = mtime
+        return self._value
+
+    def update(self, value) -> None:
+        '''値を差し替える（ファイルに書き込んだ直後に使う）'''
+        try:
+            self._mtime = os.stat(str(self.path)).st_mtime_ns
+        except FileNotFoundError:
+            self._mtime = None
+        self._value = value
+
+    def reload(self):
+        '''ファイルを読み直す'''
+        self._value = None
+        return self.get()
@@ -0,0 +1,30 @@
+import aiohttp
+
+from config import Config
+
+
+class HttpClient():
+    '''Bot全体で共有するaiohttpのセッション'''
+    _session = None
+
+    @classmethod
+    def get_session(cls) -> aiohttp.ClientSession:
+        '''共有セッションを取得する（なければ作成する）'''
+        if cls._session is None or cls._session.closed:
+            conf = Config.get_global().get('http', {})
+            connector = aiohttp.TCPConnector(
+                limit=conf.get('limit', 8),
+                keepalive_timeout=conf.get('keepalive_sec', 60))
+            timeout = aiohttp.ClientTimeout(
+                total=conf.get('timeout_sec', 30),
+                connect=conf.get('connect_timeout_sec', 10))
+            cls._session = aiohttp.ClientSession(
+                connector=connector, timeout=timeout)
+        return cls._session
+
+    @classmethod
+    async def close(cls) -> None:
+        '''共有セッションを閉じる'''
+        if cls._session is not None and not cls._session.closed:
+            await cls._session.close()
+        cls._session = None
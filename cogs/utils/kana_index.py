@@ -0,0 +1,90 @@
+import mmap
+import struct
+from collections import OrderedDict
+from pathlib import Path
+
+from .file_cache import write_atomic
+
+# ファイルの先頭（識別子, 件数）
+MAGIC = b'LKIX0001'
+HEADER = struct.Struct('<8sI')
+OFFSET = struct.Struct('<I')
+
+
+class KanaIndex():
+    '''
+    単語→読みのソート済み文字列表
+    ファイルをmmapで開くので、複数のプロセスで同じメモリ（ページキャッシュ）を共有できる
+    よく引く単語はmemo_size件までLRUで保持する
+
+    ファイルの形式:
+        ヘッダ, レコードの開始位置×(件数+1), レコード（単語\\0読み）をキーのバイト順に並べたもの
+    '''
+
+    def __init__(self, path: Path, memo_size: int = 4096):
+        self.path = path
+        self.memo_size = memo_size
+        self._memo = OrderedDict()
+        with path.open('rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._count = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            self._mm.close()
+            raise ValueError(f'Invalid kana index: {path}')
+        self._data = HEADER.size + OFFSET.size * (self._count + 1)
+
+    @staticmethod
+    def build(items, path: Path) -> None:
+        '''(単語, 読み) の一覧から索引ファイルを作成する'''
+        records = sorted(
+            (k.encode(), v.encode()) for k, v in items if '\0' not in k)
+        offsets = [0]
+        data = []
+        for key, value in records:
+            record = key + b'\0' + value
+            data.append(record)
+            offsets.append(offsets[-1] + len(record))
+        header = HEADER.pack(MAGIC, len(records))
+        table = b''.join(OFFSET.pack(o) for o in offsets)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        write_atomic(path, header + table + b''.join(data))
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _record(self, i: int) -> tuple:
+        '''i番目の (単語, 読みの開始位置, 終了位置)'''
+        pos = HEADER.size + OFFSET.size * i
+        start = self._data + OFFSET.unpack_from(self._mm, pos)[0]
+        end = self._data + OFFSET.unpack_from(self._mm, pos + OFFSET.size)[0]
+        sep = self._mm.find(b'\0', start, end)
+        return (self._mm[start:sep], sep + 1, end)
+
+    def _search(self, key: str) -> str:
+        target = key.encode()
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            k, start, end = self._record(mid)
+            if k < target:
+                lo = mid + 1
+            elif k > target:
+                hi = mid
+            else:
+                return self._mm[start:end].decode()
+        return None
+
+    def get(self, key: str) -> str:
+        '''読みを取得する（なければNone）'''
+        if key in self._memo:
+            self._memo.move_to_end(key)
+            return self._memo[key]
+        value = self._search(key)
+        # NOTE: 見つからなかった単語も覚えておく
+        self._memo[key] = value
+        if len(self._memo) > self.memo_size:
+            self._memo.popitem(last=False)
+        return value
+
+    def close(self) -> None:
+        self._mm.close()
@@ -0,0 +1,29 @@
+import importlib
+import threading
+
+
+class LazyModule():
+    '''
+    最初に属性を参照した時にモジュールを読み込む
+    読み込みに時間がかかるモジュールを起動時に読み込まないために使う
+    '''
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        '''モジュールを読み込む（読み込み済みならそれを返す）'''
+        if self._module is None:
+            # NOTE: ウォームアップのスレッドと同時に読み込まないようにする
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+        return self._module
+
+    def is_loaded(self) -> bool:
+        return self._module is not None
+
+    def __getattr__(self, name: str):
+        return getattr(self.load(), name)
@@ -0,0 +1,207 @@
+import contextvars
+import time
+from bisect import bisect_left
+
+from aiohttp import web
+
+# 現在処理しているサーバーのID
+# NOTE: 再生キューが音声の作成タスクごとに設定するので、
+#       キャッシュやダウンロードの処理にサーバーIDを渡さなくてよい
+current_guild = contextvars.ContextVar('current_guild', default=None)
+
+# 処理時間のバケット（秒）
+DEFAULT_BUCKETS = (
+    0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{n}="{v}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter():
+    '''ラベルごとの累計値'''
+
+    def __init__(self, name: str, doc: str, labels: tuple = ()):
+        self.name = name
+        self.doc = doc
+        self.labels = ('guild',) + labels
+        self._values = {}
+
+    def inc(self, values: tuple, n: float = 1) -> None:
+        self._values[values] = self._values.get(values, 0) + n
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.doc}',
+                 f'# TYPE {self.name} counter']
+        for values, v in sorted(self._values.items()):
+            lines.append(
+                f'{self.name}{_format_labels(self.labels, values)} {v}')
+        return lines
+
+
+class Gauge():
+    '''取得時に関数を呼んで現在の値を返す（サーバーごとには分けない）'''
+
+    def __init__(self, name: str, doc: str):
+        self.name = name
+        self.doc = doc
+        self.func = None
+
+    def render(self) -> list:
+        if self.func is None:
+            return []
+        return [f'# HELP {self.name} {self.doc}',
+                f'# TYPE {self.name} gauge',
+                f'{self.name} {self.func()}']
+
+
+class Histogram():
+    '''ラベルごとの値の分布'''
+
+    def __init__(
+            self, name: str, doc: str, labels: tuple = (),
+            buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.labels = ('guild',) + labels
+        self.buckets = buckets
+        # ラベル→[各バケットの件数, 合計, 件数]
+        self._values = {}
+
+    def observe(self, values: tuple, value: float) -> None:
+        data = self._values.get(values)
+        if data is None:
+            data = [[0] * len(self.buckets), 0.0, 0]
+            self._values[values] = data
+        i = bisect_left(self.buckets, value)
+        if i < len(self.buckets):
+            data[0][i] += 1
+        data[1] += value
+        data[2] += 1
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.doc}',
+                 f'# TYPE {self.name} histogram']
+        for values, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for le, c in zip(self.buckets, counts):
+                cumulative += c
+                labels = _format_labels(self.labels, values, f'le="{le}"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labels, values, 'le="+Inf"')
+            lines.append(f'{self.name}_bucket{labels} {count}')
+            labels = _format_labels(self.labels, values)
+            lines.append(f'{self.name}_sum{labels} {total}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+class Metrics():
+    '''
+    読み上げ処理の計測値
+    Prometheusのテキスト形式でHTTPから取得できる
+    '''
+    _metrics = {
+        'convert': Histogram(
+            'lunalu_convert_seconds', 'メッセージの変換にかかった時間'),
+        'stage': Histogram(
+            'lunalu_convert_stage_seconds', 'メッセージの変換の段階ごとの時間',
+            ('stage',)),
+        'synth': Histogram(
+            'lunalu_synth_seconds', '音声合成にかかった時間'),
+        'download': Histogram(
+            'lunalu_download_seconds', '音声ファイルのダウンロードにかかった時間'),
+        'queue_wait': Histogram(
+            'lunalu_queue_wait_seconds', 'キューに追加されてから再生が始まるまでの時間'),
+        'play_delay': Histogram(
+            'lunalu_play_start_delay_seconds', '前の音声が終わってから次の音声が始まるまでの時間'),
+        'cache': Counter(
+            'lunalu_cache_requests_total', 'キャッシュの参照回数',
+            ('cache', 'result')),
+        'drop': Counter(
+            'lunalu_dropped_total', '再生せずに破棄した音声の数', ('reason',)),
+        'synth_queue_depth': Gauge(
+            'lunalu_synth_queue_depth', '音声合成の実行待ちの数'),
+        'synth_running': Gauge(
+            'lunalu_synth_running', '実行中の音声合成の数'),
+    }
+    _runner = None
+
+    @classmethod
+    def _values(cls, guild_id: int, labels: tuple) -> tuple:
+        if guild_id is None:
+            guild_id = current_guild.get()
+        return (str(guild_id) if guild_id is not None else '',) + labels
+
+    @classmethod
+    def observe(cls, name: str, value: float, *labels, guild_id: int = None) -> None:
+        '''処理時間などを記録する'''
+        cls._metrics[name].observe(cls._values(guild_id, labels), value)
+
+    @classmethod
+    def inc(cls, name: str, *labels, n: float = 1, guild_id: int = None) -> None:
+        '''回数を数える'''
+        cls._metrics[name].inc(cls._values(guild_id, labels), n)
+
+    @classmethod
+    def set_gauge(cls, name: str, func) -> None:
+        '''現在の値を返す関数を登録する'''
+        cls._metrics[name].func = func
+
+    @classmethod
+    def timer(cls, name: str, *labels, guild_id: int = None):
+        '''withで囲んだ処理の時間を記録する'''
+        return _Timer(cls, name, labels, guild_id)
+
+    @classmethod
+    def render(cls) -> str:
+        '''Prometheusのテキスト形式にする'''
+        lines = []
+        for metric in cls._metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    @classmethod
+    async def start_server(cls, host: str, port: int) -> None:
+        '''/metrics で計測値を返すHTTPサーバーを起動する'''
+        if cls._runner is not None:
+            return
+
+        async def handle(request):
+            return web.Response(
+                body=cls.render().encode(),
+                headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+        app = web.Application()
+        app.router.add_get('/metrics', handle)
+        cls._runner = web.AppRunner(app)
+        await cls._runner.setup()
+        await web.TCPSite(cls._runner, host, port).start()
+        print(f'Metrics: http://{host}:{port}/metrics')
+
+    @classmethod
+    async def stop_server(cls) -> None:
+        if cls._runner is not None:
+            await cls._runner.cleanup()
+            cls._runner = None
+
+
+class _Timer():
+    def __init__(self, metrics, name: str, labels: tuple, guild_id: int):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.guild_id = guild_id
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(
+            self.name, time.perf_counter() - self.start, *self.labels,
+            guild_id=self.guild_id)
+        return False
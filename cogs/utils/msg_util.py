@@ -1,9 +1,24 @@
+import importlib.util
 import re
 import json
+import runpy
+import time
 from pathlib import Path
 
-import alkana
-import romkan
+from .file_cache import FileCache, file_lock
+from .kana_index import KanaIndex
+from .lazy_module import LazyModule
+from .metrics import Metrics
+
+# NOTE: 読み込みに時間がかかるので最初に使う時に読み込む
+romkan = LazyModule('romkan')
+
+
+def _load_re_rules(path: Path) -> list:
+    '''正規表現の置換ルールを読み込んでコンパイルする'''
+    with path.open() as f:
+        words = json.loads(f.read())
+    return [(re.compile(k), v) for k, v in words.items()]
 
 
 class MessageConverter():
@@ -13,6 +28,27 @@ class MessageConverter():
     re_roma = re.compile(r'[A-Z]?[a-z]{2,}')
 
     words_file = Path('data/json/global_words.json')
+    re_rules = FileCache(words_file, _load_re_rules)
+
+    # alkanaの辞書から作成した英語かな変換の索引
+    eng_kana_file = Path('cache/eng_kana.idx')
+    _eng_kana = None
+
+    @classmethod
+    def get_eng_kana_index(cls) -> KanaIndex:
+        '''英語かな変換の索引を開く（なければalkanaの辞書から作成する）'''
+        if cls._eng_kana is None:
+            source = Path(importlib.util.find_spec('alkana.data').origin)
+            cls.eng_kana_file.parent.mkdir(parents=True, exist_ok=True)
+            # NOTE: 複数のプロセスで同時に作成しないようにする
+            with file_lock(cls.eng_kana_file):
+                if cls.eng_kana_file.exists() is False or \
+                        cls.eng_kana_file.stat().st_mtime < source.stat().st_mtime:
+                    # NOTE: モジュールとして読み込むと辞書がメモリに残るので直接実行する
+                    data = runpy.run_path(str(source))['data']
+                    KanaIndex.build(data.items(), cls.eng_kana_file)
+            cls._eng_kana = KanaIndex(cls.eng_kana_file)
+        return cls._eng_kana
 
     @classmethod
     def replace_eng_to_kana(cls, msg: str) -> str:
@@ -22,10 +58,10 @@ class MessageConverter():
         '''
 
         _msg = msg
-        # 英語かな読み対応辞書の作成
+        index = cls.get_eng_kana_index()
         for word in cls.re_eng.findall(_msg):
-            # alkanaは小文字検索
-            read = alkana.get_kana(word.lower())
+            # 辞書は小文字で登録されている
+            read = index.get(word.lower())
             if read is not None:
                 _msg = _msg.replace(word, read, 1)
 
@@ -53,9 +89,101 @@ class MessageConverter():
         正規表現による置換を行なう
         '''
         _msg = msg
-        with cls.words_file.open() as f:
-            words = json.loads(f.read())
-        for k, v in words.items():
-            _msg = re.sub(k, v, _msg)
+        for pattern, repl in cls.re_rules.get():
+            _msg = pattern.sub(repl, _msg)
+
+        return _msg
+
+    @classmethod
+    def reload(cls) -> None:
+        '''置換ルールを読み直す'''
+        cls.re_rules.reload()
+
+
+class ConvertPipeline():
+    '''
+    文章を区切りごとに段階的に変換する
+    変換後の文字数が上限に達したら、残りの文章は変換しない
+    windowより短い文章は区切らずに全体を変換する
+    '''
+    # 文章を区切る位置（この文字の直後で区切る）
+    re_boundary = re.compile(r'[\s。、！？!?]')
+
+    def __init__(
+            self, stages: list, window: int = 200,
+            whole: tuple = (), protect=None):
+        # (名前, 変換関数) のリスト
+        self.stages = stages
+        # 一度に変換する文字数の目安
+        self.window = window
+        # 区切る前に文章全体に行なう変換の名前（stagesの先頭に並べる）
+        # NOTE: 行末や文末にマッチする正規表現などは区切ると結果が変わる
+        self.whole = [s for s in stages if s[0] in whole]
+        if self.whole != stages[:len(self.whole)]:
+            raise ValueError('Whole-message stages must come first')
+        self.segment_stages = stages[len(self.whole):]
+        # 途中で区切らない部分の正規表現（英単語やURLなど）
+        self.protect = protect
+
+    def split(self, msg: str):
+        '''長い文章を空白や句読点で区切って順番に返す'''
+        while len(msg) > self.window:
+            cut = self._find_cut(msg)
+            yield msg[:cut]
+            msg = msg[cut:]
+        if len(msg) > 0:
+            yield msg
+
+    def _find_cut(self, line: str) -> int:
+        # 上限より前の最後の区切りで切る
+        last = None
+        for r in self.re_boundary.finditer(line, 0, self.window):
+            last = r
+        if last is not None:
+            return self._avoid_protected(line, last.end())
+        # なければ上限より後の最初の区切りで切る
+        r = self.re_boundary.search(line, self.window, self.window * 4)
+        if r is not None:
+            return self._avoid_protected(line, r.end())
+        # NOTE: 区切りが全くない長い文章は単語の途中でも切る
+        return self._avoid_protected(line, self.window * 4)
+
+    def _avoid_protected(self, line: str, cut: int) -> int:
+        '''区切る位置が区切らない部分の途中なら、その部分の後ろにずらす'''
+        if self.protect is None:
+            return cut
+        for r in self.protect.finditer(line):
+            if r.start() >= cut:
+                break
+            if r.end() > cut:
+                return r.end()
+        return cut
+
+    def _apply(self, stages: list, msg: str) -> str:
+        for name, func in stages:
+            start = time.perf_counter()
+            msg = func(msg)
+            Metrics.observe('stage', time.perf_counter() - start, name)
+        return msg
+
+    def convert(self, segment: str) -> str:
+        '''区切った文章を残りの段階で変換する'''
+        return self._apply(self.segment_stages, segment)
+
+    def run(self, msg: str, max_length: int = 0) -> str:
+        '''文章を変換する。max_lengthを超えた分は「以下略」にする'''
+        msg = self._apply(self.whole, msg)
+        result = []
+        length = 0
+        for segment in self.split(msg):
+            converted = self.convert(segment)
+            result.append(converted)
+            length += len(converted)
+            if max_length != 0 and length > max_length:
+                break
 
+        _msg = ''.join(result)
+        # 長い文章はカットする
+        if max_length != 0 and len(_msg) > max_length:
+            _msg = _msg[:max_length] + '以下略'
         return _msg
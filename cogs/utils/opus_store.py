@@ -0,0 +1,97 @@
+import asyncio
+import os
+from pathlib import Path
+
+import discord
+from discord.oggparse import OggStream
+
+from .file_cache import touch
+from .metrics import Metrics
+
+
+class OggOpusSource(discord.AudioSource):
+    '''Ogg Opusファイルのパケットをそのまま送るソース'''
+
+    def __init__(self, path: Path):
+        # NOTE: 開けなかった場合でもcleanupできるようにする
+        self._file = None
+        self._file = path.open('rb')
+        self._packets = OggStream(self._file).iter_packets()
+
+    def read(self) -> bytes:
+        for packet in self._packets:
+            # NOTE: ヘッダーのパケットは音声ではないので送らない
+            if packet.startswith(b'OpusHead') or packet.startswith(b'OpusTags'):
+                continue
+            return packet
+        return b''
+
+    def is_opus(self) -> bool:
+        return True
+
+    def cleanup(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class OpusStore():
+    '''
+    音声ファイルをDiscord向けのOgg Opusに一度だけ変換して保存する
+    変換したファイルは元のファイルと同じディレクトリに置く
+    '''
+    SUFFIX = '.discord.opus'
+
+    def __init__(self, bitrate: int = 96):
+        self.bitrate = bitrate
+        # 変換中のファイル→タスク
+        self._inflight = {}
+        self.transcoded = 0
+
+    def path_for(self, path: Path) -> Path:
+        '''変換後のファイルのパス'''
+        return path.with_name(path.name.split('.')[0] + self.SUFFIX)
+
+    async def get(self, path: Path) -> Path:
+        '''変換済みのファイルを取得する（変換できなければNone）'''
+        opus_path = self.path_for(path)
+        if opus_path.exists():
+            touch(opus_path)
+            Metrics.inc('cache', 'opus', 'hit')
+            return opus_path
+        Metrics.inc('cache', 'opus', 'miss')
+
+        task = self._inflight.get(opus_path)
+        if task is None:
+            task = asyncio.ensure_future(self._transcode(path, opus_path))
+            self._inflight[opus_path] = task
+            task.add_done_callback(
+                lambda _: self._inflight.pop(opus_path, None))
+        return await asyncio.shield(task)
+
+    async def _transcode(self, path: Path, opus_path: Path) -> Path:
+        # NOTE: 他のプロセスが同じファイルを変換していても壊れないようにする
+        tmp = opus_path.with_name(f'.{opus_path.name}.{os.getpid()}.tmp')
+        cmd = [
+            'ffmpeg', '-y', '-loglevel', 'error',
+            '-i', str(path),
+            '-c:a', 'libopus', '-b:a', f'{self.bitrate}k',
+            '-ar', '48000', '-ac', '2',
+            '-frame_duration', '20', '-application', 'audio',
+            '-f', 'ogg', str(tmp),
+        ]
+        try:
+            proc = await asyncio.create_subprocess_exec(*cmd)
+            returncode = await proc.wait()
+        except FileNotFoundError:
+            print('ffmpeg not found')
+            return None
+
+        if returncode != 0 or tmp.exists() is False:
+            print(f'Transcode failed ({returncode}) : {path}')
+            if tmp.exists():
+                tmp.unlink()
+            return None
+        os.replace(str(tmp), str(opus_path))
+        self.transcoded += 1
+        return opus_path
@@ -0,0 +1,250 @@
+import asyncio
+import time
+from collections import deque
+
+import discord
+
+from .metrics import Metrics, current_guild
+from .startup import StartupTimer
+from .voice_util import AudioClip
+
+
+class QueueItem():
+    '''
+    再生待ちの音声
+    factoryは呼び出すとAudioClip（またはNone）を返すコルーチンを返す
+    '''
+
+    def __init__(self, factory, label: str = '', guild_id: int = None):
+        self.factory = factory
+        # ログ表示用のラベル
+        self.label = label
+        self.guild_id = guild_id
+        # 先読みで音声を作成しているタスク
+        self.task = None
+        self.enqueued_at = time.perf_counter()
+
+    def prepare(self) -> None:
+        '''音声の作成を開始する'''
+        if self.task is None:
+            self.task = asyncio.ensure_future(self._create())
+
+    async def _create(self) -> AudioClip:
+        # NOTE: タスクごとのコンテキストなので他の音声には影響しない
+        current_guild.set(self.guild_id)
+        return await self.factory()
+
+    def is_ready(self) -> bool:
+        '''音声の作成が終わっているかどうか'''
+        return self.task is not None and self.task.done()
+
+    def result(self) -> AudioClip:
+        '''作成した音声を取得する（失敗していたらNone）'''
+        if self.task.cancelled():
+            return None
+        if self.task.exception() is not None:
+            print(f'Create voice error : {self.task.exception()}')
+            return None
+        return self.task.result()
+
+    def discard(self) -> None:
+        '''音声を破棄する'''
+        if self.task is None:
+            return
+        # NOTE: 作成中の場合は作成し終わってから一時ファイルを削除する
+        self.task.add_done_callback(lambda _: self._cleanup())
+
+    def _cleanup(self) -> None:
+        clip = self.result()
+        if clip is not None:
+            clip.cleanup()
+
+
+class GapStats():
+    '''音声と音声の間の空白時間の統計'''
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+        # 前の音声の終了時に次の音声が作成済みだった回数
+        self.ready = 0
+
+    def add(self, gap: float, ready: bool) -> None:
+        self.count += 1
+        self.total += gap
+        self.max = max(self.max, gap)
+        self.last = gap
+        if ready:
+            self.ready += 1
+
+    @property
+    def average(self) -> float:
+        return self.total / self.count if self.count > 0 else 0.0
+
+
+class PlaybackQueue():
+    '''
+    VoiceClientごとのFIFO再生キュー
+    先頭からprefetch件の音声を先に作成しておき、
+    再生終了時のafterコールバックで次の音声を再生する
+    '''
+    # キューが満杯の時に新しい音声を捨てる
+    DROP_NEW = 'drop_new'
+    # キューが満杯の時に一番古い音声を捨てる
+    DROP_OLDEST = 'drop_oldest'
+
+    def __init__(
+            self, voice_client: discord.VoiceClient,
+            max_depth: int = 20, policy: str = DROP_NEW, prefetch: int = 2):
+        if policy not in (self.DROP_NEW, self.DROP_OLDEST):
+            raise ValueError(f'Invalid drop policy: {policy}')
+        self.voice_client = voice_client
+        self.guild_id = voice_client.guild.id
+        self.max_depth = max(1, max_depth)
+        self.policy = policy
+        self.prefetch = max(1, prefetch)
+        self._loop = asyncio.get_event_loop()
+        self._items = deque()
+        self._current = None
+        self._started_at = 0.0
+        # 直前の音声の終了時刻（続けて再生する音声がない場合はNone）
+        self._finished_at = None
+        self._next_was_ready = False
+        # 再生時間の移動平均（待ち時間の見積もりに使う）
+        self._avg_duration = 3.0
+        # 捨てた音声の数
+        self.dropped = 0
+        self.gaps = GapStats()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def is_playing(self) -> bool:
+        '''再生中かどうか'''
+        return self._current is not None
+
+    def preparing(self) -> int:
+        '''作成中の音声の数'''
+        return len([1 for item in self._items
+                    if item.task is not None and not item.task.done()])
+
+    def put(self, factory, label: str = '') -> bool:
+        '''音声の作成処理をキューに追加する。捨てた場合はFalseを返す'''
+        if len(self._items) >= self.max_depth:
+            if self.policy == self.DROP_NEW:
+                self._drop(QueueItem(factory, label), 'queue_full')
+                return False
+            self._drop(self._items.popleft(), 'queue_full')
+
+        self._items.append(QueueItem(factory, label, self.guild_id))
+        self._play_next()
+        return True
+
+    def skip(self) -> bool:
+        '''再生中の音声をスキップする'''
+        if self._current is None:
+            return False
+        # NOTE: 停止するとafterが呼ばれて次の音声が再生される
+        self.voice_client.stop()
+        return True
+
+    def clear(self) -> int:
+        '''再生待ちの音声を全て破棄し、破棄した数を返す'''
+        count = len(self._items)
+        while self._items:
+            self._items.popleft().discard()
+        self._finished_at = None
+        if count > 0:
+            Metrics.inc('drop', 'cleared', n=count, guild_id=self.guild_id)
+        return count
+
+    def wait_time(self) -> float:
+        '''新しく追加した音声が再生されるまでの見積もり時間（秒）'''
+        wait = self._avg_duration * len(self._items)
+        if self._current is not None:
+            elapsed = time.perf_counter() - self._started_at
+            wait += max(0.0, self._avg_duration - elapsed)
+        return wait
+
+    def _drop(self, item: QueueItem, reason: str) -> None:
+        print(f'Play canceled : {item.label}')
+        item.discard()
+        self.dropped += 1
+        Metrics.inc('drop', reason, guild_id=self.guild_id)
+
+    def _prefetch(self) -> None:
+        '''先頭から指定件数の音声の作成を開始する'''
+        for i, item in enumerate(self._items):
+            if i >= self.prefetch:
+                break
+            if item.task is None:
+                item.prepare()
+                item.task.add_done_callback(lambda _: self._play_next())
+
+    def _play_next(self) -> None:
+        self._prefetch()
+        if self._current is not None:
+            return
+
+        while self._items:
+            if self.voice_client.is_connected() is False:
+                self.clear()
+                return
+
+            # 先頭の音声の作成が終わるまで待つ
+            item = self._items[0]
+            if item.is_ready() is False:
+                return
+            self._items.popleft()
+            self._prefetch()
+
+            clip = item.result()
+            if clip is None:
+                Metrics.inc('drop', 'create_failed', guild_id=self.guild_id)
+                continue
+            try:
+                self.voice_client.play(clip.to_source(), after=self._after)
+            except (discord.ClientException, OSError):
+                # NOTE: 再生までにキャッシュのファイルが削除されている場合がある
+                clip.cleanup()
+                self._drop(item, 'play_error')
+                continue
+
+            self._current = clip
+            self._started_at = time.perf_counter()
+            wait = self._started_at - item.enqueued_at
+            Metrics.observe('queue_wait', wait, guild_id=self.guild_id)
+            if StartupTimer.mark('first_utterance'):
+                StartupTimer.add('first_utterance_wait', wait)
+                print(StartupTimer.report())
+            if self._finished_at is not None:
+                gap = self._started_at - self._finished_at
+                self.gaps.add(gap, self._next_was_ready)
+                Metrics.observe('play_delay', gap, guild_id=self.guild_id)
+            return
+
+        # 続けて再生する音声がなければ空白時間として数えない
+        self._finished_at = None
+
+    def _after(self, error) -> None:
+        # NOTE: 再生スレッドから呼ばれるのでイベントループに処理を戻す
+        self._loop.call_soon_threadsafe(self._finish, error)
+
+    def _finish(self, error) -> None:
+        clip = self._current
+        self._current = None
+        if clip is not None:
+            clip.cleanup()
+            duration = time.perf_counter() - self._started_at
+            self._avg_duration = self._avg_duration * 0.8 + duration * 0.2
+        if error is not None:
+            print(f'Play error : {error}')
+
+        if self._items:
+            self._finished_at = time.perf_counter()
+            self._next_was_ready = self._items[0].is_ready()
+        else:
+            self._finished_at = None
+        self._play_next()
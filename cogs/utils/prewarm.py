@@ -0,0 +1,61 @@
+import asyncio
+import time
+
+from .voice_util import VoiceFactory
+
+
+class PrewarmReport():
+    '''事前取得の結果'''
+
+    def __init__(self):
+        self.ok = 0
+        # (サウンド名, URL, 理由)
+        self.failed = []
+        self.elapsed = 0.0
+
+    @property
+    def total(self) -> int:
+        return self.ok + len(self.failed)
+
+    def summary(self) -> str:
+        lines = [f'{self.ok}/{self.total} 件取得（{self.elapsed:.1f}秒）']
+        for name, url, reason in self.failed:
+            lines.append(f'・{name}: {reason} {url}')
+        return '\n'.join(lines)
+
+
+async def prewarm_sounds(parallel: int = 4) -> PrewarmReport:
+    '''
+    sound_links.jsonの全サウンドを取得してOpusに変換しておく
+    キャッシュ済みでもリンク切れを見つけられるようにサーバーに確認する
+    同時に取得する数はparallelで制限する
+    '''
+    report = PrewarmReport()
+    semaphore = asyncio.Semaphore(max(1, parallel))
+    cache = VoiceFactory.get_clip_cache()
+
+    async def fetch(name: str, url: str) -> None:
+        async with semaphore:
+            cache.errors.pop(url, None)
+            try:
+                clip = await VoiceFactory.create_voice_from_url(
+                    url, revalidate=True)
+            except Exception as e:
+                clip = None
+                cache.errors[url] = str(e) or type(e).__name__
+        # NOTE: 古いキャッシュで再生できてもリンク切れとして報告する
+        if clip is None or url in cache.errors:
+            report.failed.append(
+                (name, url, cache.errors.get(url, 'unknown error')))
+        else:
+            report.ok += 1
+
+    start = time.perf_counter()
+    tasks = []
+    for sound in VoiceFactory.get_sound_list():
+        name = sound.get('name', sound['reg'])
+        for url in VoiceFactory.get_sound_links(sound):
+            tasks.append(fetch(name, url))
+    await asyncio.gather(*tasks)
+    report.elapsed = time.perf_counter() - start
+    return report
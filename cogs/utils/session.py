@@ -0,0 +1,102 @@
+import discord
+
+from config import Config
+from .playback import PlaybackQueue
+
+
+class GuildSession():
+    '''サーバーごとの読み上げ状態'''
+
+    def __init__(self, guild_id: int):
+        self.guild_id = guild_id
+        # 接続中のVoiceClient
+        self.voice_client = None
+        # 読み上げ対象のテキストチャンネル
+        self.target_channel = None
+        # 再生キュー
+        self.queue = None
+
+    def attach(self, voice_client: discord.VoiceClient) -> None:
+        '''VoiceClientを設定し、再生キューを作成する'''
+        if self.voice_client is voice_client and self.queue is not None:
+            return
+        if self.queue is not None:
+            self.queue.clear()
+        conf = Config.get_global().get('queue', {})
+        self.voice_client = voice_client
+        self.queue = PlaybackQueue(
+            voice_client,
+            max_depth=conf.get('max_depth', 20),
+            policy=conf.get('policy', PlaybackQueue.DROP_NEW),
+            prefetch=conf.get('prefetch', 2))
+
+    def detach(self) -> None:
+        '''VoiceClientと再生キューを破棄する'''
+        if self.queue is not None:
+            self.queue.clear()
+        self.queue = None
+        self.voice_client = None
+
+    def is_connected(self) -> bool:
+        '''VCに接続中かどうか'''
+        return self.voice_client is not None and\
+            self.voice_client.is_connected()
+
+    def set_target(self, channel: discord.TextChannel) -> None:
+        '''読み上げ対象のテキストチャンネルを設定する（Noneで解除）'''
+        if self.target_channel is not None:
+            SessionStore.unwatch(self.guild_id, self.target_channel.id)
+        self.target_channel = channel
+        if channel is not None:
+            SessionStore.watch(self.guild_id, channel.id)
+
+    def is_target(self, channel: discord.abc.Messageable) -> bool:
+        '''読み上げ対象のチャンネルかどうか'''
+        return self.target_channel is not None and\
+            self.target_channel.id == channel.id
+
+
+class SessionStore():
+    '''サーバーIDをキーにしたセッションの管理'''
+    _sessions = {}
+    # 読み上げ対象の (サーバーID, テキストチャンネルID)
+    _watched = set()
+
+    @classmethod
+    def watch(cls, guild_id: int, channel_id: int) -> None:
+        cls._watched.add((guild_id, channel_id))
+
+    @classmethod
+    def unwatch(cls, guild_id: int, channel_id: int) -> None:
+        cls._watched.discard((guild_id, channel_id))
+
+    @classmethod
+    def is_watched(cls, guild_id: int, channel_id: int) -> bool:
+        '''読み上げ対象のチャンネルかどうか'''
+        return (guild_id, channel_id) in cls._watched
+
+    @classmethod
+    def get(cls, guild_id: int) -> GuildSession:
+        '''セッションを取得する（なければNone）'''
+        return cls._sessions.get(guild_id)
+
+    @classmethod
+    def get_or_create(cls, guild_id: int) -> GuildSession:
+        '''セッションを取得する（なければ作成する）'''
+        session = cls._sessions.get(guild_id)
+        if session is None:
+            session = GuildSession(guild_id)
+            cls._sessions[guild_id] = session
+        return session
+
+    @classmethod
+    def remove(cls, guild_id: int) -> None:
+        '''セッションを破棄する'''
+        session = cls._sessions.pop(guild_id, None)
+        if session is not None:
+            session.set_target(None)
+
+    @classmethod
+    def all(cls) -> list:
+        '''全セッションを取得する'''
+        return list(cls._sessions.values())
@@ -0,0 +1,118 @@
+import atexit
+import json
+import threading
+from collections import Counter
+from pathlib import Path
+
+from .file_cache import file_lock, write_atomic
+
+
+class SoundLog():
+    '''
+    サウンドの使用回数をメモリ上で数え、まとめてファイルに書き込む
+    書き込みは最初の使用からflush_delay秒後に行なう
+    複数のプロセスで動かしても数え漏れがないように、
+    書き込み時にファイルを読み直して増えた分だけを足す
+    '''
+    LOG_FILE = Path('../lunalu-bot/data/json/sound_log.json')
+    flush_delay = 30.0
+
+    _users = None
+    _guilds = None
+    _sound_count = 0
+    # 前回の書き込みから増えた回数
+    _pending = []
+    _timer = None
+    _lock = threading.RLock()
+
+    @classmethod
+    def _load(cls) -> None:
+        if cls._users is not None:
+            return
+        cls._read()
+
+    @classmethod
+    def _read(cls) -> None:
+        cls._users = {}
+        cls._guilds = {}
+        if cls.LOG_FILE.exists() is False:
+            return
+        with cls.LOG_FILE.open() as f:
+            logs = json.loads(f.read())
+        cls._sound_count = max(cls._sound_count, logs.get('sound_count', 0))
+        # NOTE: ファイル上はサウンドIDの順に並んだ回数のリスト
+        for key, data in (('user_data', cls._users), ('guild_data', cls._guilds)):
+            for _id, counts in logs.get(key, {}).items():
+                data[_id] = Counter(
+                    {i + 1: c for i, c in enumerate(counts) if c > 0})
+
+    @classmethod
+    def _count(cls, sound_id: int, user_id: str, guild_id: str) -> None:
+        cls._users.setdefault(user_id, Counter())[sound_id] += 1
+        if guild_id is not None:
+            cls._guilds.setdefault(guild_id, Counter())[sound_id] += 1
+
+    @classmethod
+    def add(cls, sound_id: int, user_id: int, guild_id: int = None) -> None:
+        '''サウンドの使用回数を追加する'''
+        with cls._lock:
+            cls._load()
+            guild_id = str(guild_id) if guild_id is not None else None
+            cls._count(sound_id, str(user_id), guild_id)
+            cls._pending.append((sound_id, str(user_id), guild_id))
+            cls._sound_count = max(cls._sound_count, sound_id)
+            if cls._timer is None:
+                cls._timer = threading.Timer(cls.flush_delay, cls.flush)
+                cls._timer.daemon = True
+                cls._timer.start()
+
+    @classmethod
+    def top(cls, user_id: int = None, guild_id: int = None, n: int = 5) -> list:
+        '''
+        よく使われたサウンドIDと回数を多い順に返す
+        user_idとguild_idを省略した場合は全体の回数を返す
+        '''
+        with cls._lock:
+            cls._load()
+            if user_id is not None:
+                counts = cls._users.get(str(user_id), Counter())
+            elif guild_id is not None:
+                counts = cls._guilds.get(str(guild_id), Counter())
+            else:
+                counts = sum(cls._users.values(), Counter())
+            return counts.most_common(n)
+
+    @classmethod
+    def flush(cls) -> None:
+        '''使用回数を書き込む'''
+        with cls._lock:
+            if cls._timer is not None:
+                cls._timer.cancel()
+                cls._timer = None
+            if len(cls._pending) < 1:
+                return
+            pending = cls._pending
+            cls._pending = []
+
+            with file_lock(cls.LOG_FILE):
+                # 他のプロセスが書き込んだ回数に今回の分を足す
+                cls._read()
+                for args in pending:
+                    cls._count(*args)
+                cls._write()
+
+    @classmethod
+    def _write(cls) -> None:
+        def to_list(counter: Counter) -> list:
+            # IDは1から開始しているため-1する
+            return [counter.get(i + 1, 0) for i in range(cls._sound_count)]
+
+        logs = {
+            'sound_count': cls._sound_count,
+            'user_data': {k: to_list(v) for k, v in cls._users.items()},
+            'guild_data': {k: to_list(v) for k, v in cls._guilds.items()},
+        }
+        write_atomic(cls.LOG_FILE, json.dumps(logs, separators=(',', ':')))
+
+
+atexit.register(SoundLog.flush)
@@ -0,0 +1,69 @@
+import json
+import re
+from pathlib import Path
+
+# 結合すると番号がずれてしまう後方参照やグループ名、
+# 先頭以外に書けないインラインフラグ（例: (?i)）
+_UNSAFE_RE = re.compile(r'\\[1-9]|\(\?P[<=]|^\(\?[aiLmsux]+\)')
+
+
+class SoundMatcher():
+    '''
+    サウンドの正規表現を1つの選択パターンにまとめて判定する
+    登録順に最初に全体一致したサウンドを返す
+    '''
+
+    def __init__(self, sounds: list):
+        self.sounds = sounds
+        # (正規表現, グループ名→サウンド, 単独で判定するサウンド)
+        self._matchers = []
+
+        chunk = []
+        for sound in sounds:
+            if _UNSAFE_RE.search(sound['reg']) is None:
+                chunk.append(sound)
+                continue
+            # NOTE: 結合できないものは単独で判定する（順序は維持する）
+            self._add_chunk(chunk)
+            chunk = []
+            self._add_single(sound)
+        self._add_chunk(chunk)
+
+    def _add_single(self, sound: dict) -> None:
+        try:
+            self._matchers.append(
+                (re.compile(sound['reg'], re.I), None, sound))
+        except re.error as e:
+            print(f"Invalid sound pattern ({e}) : {sound['reg']}")
+
+    def _add_chunk(self, chunk: list) -> None:
+        if len(chunk) < 1:
+            return
+        names = {}
+        patterns = []
+        for i, sound in enumerate(chunk):
+            name = f's{i}'
+            names[name] = sound
+            patterns.append(f"(?P<{name}>(?:{sound['reg']}))")
+        try:
+            pattern = re.compile('|'.join(patterns), re.I)
+        except re.error:
+            # NOTE: 結合できないパターンが含まれていたら1つずつ判定する
+            for sound in chunk:
+                self._add_single(sound)
+            return
+        self._matchers.append((pattern, names, None))
+
+    @classmethod
+    def load(cls, path: Path) -> 'SoundMatcher':
+        with path.open() as f:
+            return cls(json.loads(f.read()))
+
+    def match(self, msg: str) -> dict:
+        '''メッセージ全体に一致したサウンドを返す（なければNone）'''
+        for pattern, names, sound in self._matchers:
+            r = pattern.fullmatch(msg)
+            if r is None:
+                continue
+            return names[r.lastgroup] if names is not None else sound
+        return None
@@ -0,0 +1,40 @@
+import time
+
+# NOTE: main.pyで最初に読み込むので、ほぼプロセスの起動時刻になる
+_origin = time.perf_counter()
+
+
+class StartupTimer():
+    '''起動にかかった時間を記録する'''
+    # 名前→起動からの時間（秒）
+    _marks = {}
+    # 名前→かかった時間（秒）
+    _durations = {}
+
+    @classmethod
+    def mark(cls, name: str) -> bool:
+        '''起動からの時間を記録する。記録済みならFalseを返す'''
+        if name in cls._marks:
+            return False
+        cls._marks[name] = time.perf_counter() - _origin
+        return True
+
+    @classmethod
+    def add(cls, name: str, seconds: float) -> None:
+        '''処理にかかった時間を記録する'''
+        cls._durations[name] = seconds
+
+    @classmethod
+    def get(cls, name: str) -> float:
+        return cls._marks.get(name, cls._durations.get(name))
+
+    @classmethod
+    def report(cls) -> str:
+        lines = ['起動からの時間']
+        for name, sec in cls._marks.items():
+            lines.append(f'  {name:<24}{sec:>8.3f}s')
+        if len(cls._durations) > 0:
+            lines.append('処理時間')
+            for name, sec in cls._durations.items():
+                lines.append(f'  {name:<24}{sec:>8.3f}s')
+        return '\n'.join(lines)
@@ -0,0 +1,264 @@
+import asyncio
+import importlib.util
+import io
+import wave
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+try:
+    import audioop
+except ImportError:
+    audioop = None
+
+# NOTE: numpyは読み込みに時間がかかるので、audioopがない時だけ使う
+np = None
+if audioop is None:
+    try:
+        import numpy as np
+    except ImportError:
+        np = None
+
+try:
+    import pyopenjtalk
+except ImportError:
+    pyopenjtalk = None
+
+# 16bitモノラルのPCMデータとサンプリング周波数
+Pcm = namedtuple('Pcm', ['data', 'rate'])
+
+# Discordに送るPCMの形式（48kHz 16bitステレオ、20msごと）
+DISCORD_RATE = 48000
+DISCORD_FRAME_SIZE = DISCORD_RATE // 50 * 2 * 2
+
+
+def pcm_to_wav(pcm: Pcm) -> bytes:
+    '''PCMデータをWAVファイルのデータに変換する'''
+    buf = io.BytesIO()
+    with wave.open(buf, 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(pcm.rate)
+        w.writeframes(pcm.data)
+    return buf.getvalue()
+
+
+def pcm_to_discord(pcm: Pcm) -> bytes:
+    '''
+    PCMデータを48kHzステレオに変換する
+    最後のフレームが欠けないように無音で埋める
+    '''
+    data = pcm.data
+    if audioop is not None:
+        if pcm.rate != DISCORD_RATE:
+            data, _ = audioop.ratecv(data, 2, 1, pcm.rate, DISCORD_RATE, None)
+        data = audioop.tostereo(data, 2, 1, 1)
+    else:
+        # NOTE: audioopがない環境（Python 3.13以降）ではnumpyで変換する
+        x = np.frombuffer(data, dtype=np.int16)
+        if pcm.rate != DISCORD_RATE and len(x) > 0:
+            n = int(len(x) * DISCORD_RATE / pcm.rate)
+            x = np.interp(
+                np.arange(n) * (pcm.rate / DISCORD_RATE),
+                np.arange(len(x)), x).astype(np.int16)
+        data = np.repeat(x, 2).tobytes()
+
+    remainder = len(data) % DISCORD_FRAME_SIZE
+    if remainder > 0:
+        data += b'\x00' * (DISCORD_FRAME_SIZE - remainder)
+    return data
+
+
+def wav_to_pcm(data: bytes) -> Pcm:
+    '''WAVファイルのデータをPCMデータに変換する'''
+    with wave.open(io.BytesIO(data), 'rb') as w:
+        if w.getnchannels() != 1 or w.getsampwidth() != 2:
+            raise ValueError('Only 16bit mono wav is supported')
+        return Pcm(w.readframes(w.getnframes()), w.getframerate())
+
+
+class SynthesisPool():
+    '''
+    open_jtalkを非同期サブプロセスで実行するワーカープール
+    同時に実行するプロセス数はsizeで制限する
+    '''
+
+    def __init__(self, size: int):
+        self.size = max(1, size)
+        self._semaphore = None
+        # 実行待ちの数
+        self._waiting = 0
+        # 実行中の数
+        self._running = 0
+
+    @property
+    def queue_depth(self) -> int:
+        '''実行待ちの合成数'''
+        return self._waiting
+
+    @property
+    def running(self) -> int:
+        '''実行中の合成数'''
+        return self._running
+
+    async def run(self, cmd: list, input: bytes = None) -> tuple:
+        '''コマンドを実行し、(終了コード, 標準出力) を返す'''
+        # NOTE: イベントループ起動後に作成する
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.size)
+
+        self._waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self._waiting -= 1
+
+        self._running += 1
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE)
+            stdout, _ = await proc.communicate(input)
+            return (proc.returncode, stdout)
+        finally:
+            self._running -= 1
+            self._semaphore.release()
+
+
+class SubprocessBackend():
+    '''
+    合成のたびにopen_jtalkを起動する
+    文章は標準入力で渡し、WAVは標準出力で受け取る
+    '''
+
+    def __init__(self, size: int, dict_dir: Path):
+        self.pool = SynthesisPool(size)
+        self.dict_dir = dict_dir
+
+    @property
+    def queue_depth(self) -> int:
+        return self.pool.queue_depth
+
+    @property
+    def running(self) -> int:
+        return self.pool.running
+
+    @property
+    def size(self) -> int:
+        return self.pool.size
+
+    async def synthesize(self, text: str, voice_path: Path, setting: dict) -> Pcm:
+        '''音声を合成する（失敗したらNone）'''
+        cmd = [
+            'open_jtalk',
+            '-x', str(self.dict_dir),
+            '-m', str(voice_path),
+            '-ow', '/dev/stdout',
+            '-r', str(setting['speed']),
+            '-fm', str(setting['tone']),
+            '-jf', str(setting['intone']),
+            '-u', str(setting['threshold']),
+            # NOTE: Linuxだと音量が無効なオプションと言われるので一旦避難
+            # '-g', str(setting['volume']),
+        ]
+
+        # NOTE: イベントループを止めないようにプール経由で実行する
+        returncode, data = await self.pool.run(cmd, text.encode())
+        if returncode != 0 or len(data) < 1:
+            print(f'open_jtalk failed ({returncode}) : {text}')
+            return None
+        return wav_to_pcm(data)
+
+    def close(self) -> None:
+        pass
+
+
+# ====== 常駐ワーカープロセス用 ======
+_jtalk = None
+_engines = {}
+_np = None
+
+
+def _init_worker(dict_dir: str) -> None:
+    '''ワーカープロセスの起動時に辞書を読み込む'''
+    global _jtalk, _np
+    # NOTE: 合成結果の変換に必要なので、audioopの有無に関わらず読み込む
+    import numpy
+    _np = numpy
+    _jtalk = pyopenjtalk.OpenJTalk(dn_mecab=dict_dir.encode())
+
+
+def _synthesize_in_worker(text: str, voice_path: str, speed: float, tone: float) -> Pcm:
+    # 音響モデルは一度読み込んだら使い回す
+    engine = _engines.get(voice_path)
+    if engine is None:
+        engine = pyopenjtalk.HTSEngine(voice_path.encode())
+        _engines[voice_path] = engine
+
+    labels = _jtalk.make_label(_jtalk.run_frontend(text))
+    engine.set_speed(speed)
+    engine.add_half_tone(tone)
+    x = engine.synthesize(labels)
+    data = _np.clip(x, -32768, 32767).astype(_np.int16).tobytes()
+    return Pcm(data, engine.get_sampling_frequency())
+
+
+class HtsBackend():
+    '''
+    辞書と音響モデルを読み込んだままのワーカープロセスで合成する
+    NOTE: pyopenjtalkが必要。イントネーションと閾値の設定には未対応
+    '''
+
+    def __init__(self, size: int, dict_dir: Path):
+        if pyopenjtalk is None:
+            raise RuntimeError('HtsBackend requires pyopenjtalk')
+        if importlib.util.find_spec('numpy') is None:
+            raise RuntimeError('HtsBackend requires numpy')
+        self.size = max(1, size)
+        self.dict_dir = dict_dir
+        self._executor = self._create_executor()
+        # 実行待ちと実行中の合計
+        self._pending = 0
+
+    def _create_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers=self.size,
+            initializer=_init_worker, initargs=(str(self.dict_dir),))
+
+    @property
+    def queue_depth(self) -> int:
+        return max(0, self._pending - self.size)
+
+    @property
+    def running(self) -> int:
+        return min(self._pending, self.size)
+
+    async def synthesize(self, text: str, voice_path: Path, setting: dict) -> Pcm:
+        '''音声を合成する（失敗したらNone）'''
+        loop = asyncio.get_event_loop()
+        self._pending += 1
+        try:
+            for retry in (True, False):
+                executor = self._executor
+                try:
+                    return await loop.run_in_executor(
+                        executor, _synthesize_in_worker,
+                        text, str(voice_path), setting['speed'], setting['tone'])
+                except BrokenProcessPool:
+                    # NOTE: ワーカーが落ちると以後の合成が全て失敗するので作り直す
+                    if executor is self._executor:
+                        print('HTS worker died. Restarting the pool')
+                        executor.shutdown(wait=False)
+                        self._executor = self._create_executor()
+                    if retry is False:
+                        raise
+        except Exception as e:
+            print(f'HTS engine failed ({e}) : {text}')
+            return None
+        finally:
+            self._pending -= 1
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False)
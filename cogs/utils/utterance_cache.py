@@ -0,0 +1,102 @@
+import hashlib
+import json
+import unicodedata
+from collections import OrderedDict
+from pathlib import Path
+
+from .file_cache import evict_lru, touch, write_atomic
+from .synth_backend import Pcm, pcm_to_wav, wav_to_pcm
+
+
+class UtteranceCache():
+    '''
+    合成した音声のキャッシュ
+    (文章, 声のパラメータ) をキーにしてメモリ上にLRUで保持し、
+    メモリから溢れたものはディスクに書き出す
+    '''
+    # キーに含める声のパラメータ
+    PARAMS = ('voice', 'speed', 'tone', 'intone', 'threshold')
+    # ディスクが上限を超えたらこの割合まで削除する
+    EVICT_RATIO = 0.9
+
+    def __init__(
+            self, directory: Path,
+            memory_bytes: int = 32 * 1024 * 1024,
+            disk_bytes: int = 256 * 1024 * 1024):
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self._items = OrderedDict()
+        self._size = 0
+        # ディスク上の合計サイズ（の上限の見積もり）。Noneなら未確認
+        self._disk_size = None
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @classmethod
+    def make_key(cls, text: str, setting: dict) -> str:
+        '''文章と声のパラメータからキーを作成する'''
+        text = ' '.join(unicodedata.normalize('NFKC', text).split())
+        params = [text] + [
+            round(v, 4) if isinstance(v, float) else v
+            for v in (setting[p] for p in cls.PARAMS)]
+        raw = json.dumps(params, ensure_ascii=False)
+        return hashlib.sha1(raw.encode()).hexdigest()
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.memory_hits + self.disk_hits + self.misses
+        return (self.memory_hits + self.disk_hits) / total if total > 0 else 0.0
+
+    def get(self, key: str) -> Pcm:
+        '''キャッシュ済みの音声を取得する（なければNone）'''
+        pcm = self._items.get(key)
+        if pcm is not None:
+            self._items.move_to_end(key)
+            self.memory_hits += 1
+            return pcm
+
+        path = self.directory / f'{key}.wav'
+        if path.exists():
+            with path.open('rb') as f:
+                pcm = wav_to_pcm(f.read())
+            touch(path)
+            self.disk_hits += 1
+            self._put_memory(key, pcm)
+            return pcm
+
+        self.misses += 1
+        return None
+
+    def put(self, key: str, pcm: Pcm) -> None:
+        '''音声をキャッシュする'''
+        self._put_memory(key, pcm)
+
+    def _put_memory(self, key: str, pcm: Pcm) -> None:
+        if key in self._items:
+            self._size -= len(self._items.pop(key).data)
+        self._items[key] = pcm
+        self._size += len(pcm.data)
+
+        # メモリから溢れたものをディスクに書き出す
+        spilled = False
+        while self._size > self.memory_bytes and len(self._items) > 1:
+            old_key, old_pcm = self._items.popitem(last=False)
+            self._size -= len(old_pcm.data)
+            path = self.directory / f'{old_key}.wav'
+            if path.exists() is False:
+                self.directory.mkdir(parents=True, exist_ok=True)
+                data = pcm_to_wav(old_pcm)
+                write_atomic(path, data)
+                if self._disk_size is not None:
+                    self._disk_size += len(data)
+                spilled = True
+
+        # NOTE: ディレクトリの走査は重いので、見積もりが上限を超えたときだけ行う
+        #       上限より少し下まで削除して、しばらく走査しなくてよいようにする
+        if spilled and (
+                self._disk_size is None or self._disk_size > self.disk_bytes):
+            low = int(self.disk_bytes * self.EVICT_RATIO)
+            evict_lru(self.directory, low)
+            self._disk_size = low
@@ -1,24 +1,95 @@
 import io
-import aiohttp
-import time
 import os
 import json
 import re
 import random
-import subprocess
 from copy import copy
 from pathlib import Path
+
+import discord
+
+from .clip_cache import ClipCache
+from .file_cache import FileCache
 from .math_util import MathUtility
+from .metrics import Metrics
+from .opus_store import OggOpusSource, OpusStore
+from .sound_log import SoundLog
+from .sound_matcher import SoundMatcher
+from .synth_backend import HtsBackend, Pcm, SubprocessBackend, pcm_to_discord
+from .utterance_cache import UtteranceCache
+from config import Config
 from setting import UserSetting
 
 
+class AudioClip():
+    '''再生する音声（ファイルかメモリ上のPCMデータ）'''
+
+    def __init__(
+            self, path: Path = None, temporary: bool = True,
+            pcm: Pcm = None, opus: bool = False):
+        self.path = path
+        # 再生後に削除する一時ファイルかどうか
+        self.temporary = temporary
+        # 合成した音声のPCMデータ
+        self.pcm = pcm
+        # pathがDiscord向けに変換済みのOgg Opusかどうか
+        self.opus = opus
+
+    def to_source(self) -> discord.AudioSource:
+        '''再生用のAudioSourceを作成する'''
+        if self.pcm is not None:
+            # NOTE: ffmpegを使わずにメモリ上で変換して再生する
+            return discord.PCMAudio(io.BytesIO(pcm_to_discord(self.pcm)))
+        if self.opus:
+            # NOTE: 変換済みなのでデコードもエンコードもせずに送る
+            return OggOpusSource(self.path)
+        return discord.FFmpegPCMAudio(str(self.path))
+
+    def cleanup(self) -> None:
+        '''一時ファイルを削除する'''
+        if self.path is not None and self.temporary and self.path.exists():
+            self.path.unlink()
+
+
 class VoiceFactory():
-    TEMP_DIR = Path('/tmp')
     DICT_DIR = Path(os.environ['DIC_DIR'])
     SYS_VOICE_DIR = Path(os.environ['SYS_VOICE_DIR'])
     SOUND_LINK_FILE = Path('../lunalu-bot/data/json/sound_links.json')
     VOICE_LINK_FILE = Path('../lunalu-bot/data/json/voice_links.json')
-    SOUND_LOG_FILE = Path('../lunalu-bot/data/json/sound_log.json')
+
+    _backend = None
+    _clip_cache = None
+    _utterance_cache = None
+    _opus_store = None
+    _sound_matcher = FileCache(SOUND_LINK_FILE, SoundMatcher.load)
+    _voice_list = FileCache(
+        VOICE_LINK_FILE, lambda p: json.loads(p.read_text()))
+
+    @classmethod
+    def get_backend(cls):
+        '''
+        音声合成のバックエンドを取得する
+        synth_backendが"hts"ならワーカープロセスで、
+        "subprocess"なら毎回open_jtalkを起動して合成する
+        '''
+        if cls._backend is None:
+            conf = Config.get_global()
+            size = conf.get('synth_workers', os.cpu_count() or 1)
+            if conf.get('synth_backend', 'subprocess') == 'hts':
+                cls._backend = HtsBackend(size, cls.DICT_DIR)
+            else:
+                cls._backend = SubprocessBackend(size, cls.DICT_DIR)
+            backend = cls._backend
+            Metrics.set_gauge('synth_queue_depth', lambda: backend.queue_depth)
+            Metrics.set_gauge('synth_running', lambda: backend.running)
+        return cls._backend
+
+    @classmethod
+    def close_backend(cls) -> None:
+        '''音声合成のワーカーを終了する'''
+        if cls._backend is not None:
+            cls._backend.close()
+            cls._backend = None
 
     @classmethod
     def get_user_setting(cls, user_id: int) -> dict:
@@ -40,106 +111,118 @@ class VoiceFactory():
         return _setting
 
     @classmethod
-    def get_sound_list(cls) -> dict:
-        with cls.SOUND_LINK_FILE.open() as f:
-            sounds = json.loads(f.read())
-
-        return sounds
+    def get_sound_list(cls) -> list:
+        return cls._sound_matcher.get().sounds
 
     @classmethod
-    def get_voice_list(cls) -> dict:
-        with cls.VOICE_LINK_FILE.open() as f:
-            voices = json.loads(f.read())
+    def get_sound_links(cls, sound: dict) -> list:
+        '''サウンドに登録されているURLの一覧（改行区切り）'''
+        return re.findall(r'^http.*$', sound['links'], re.M)
 
-        return voices
+    @classmethod
+    def reload_sounds(cls) -> None:
+        '''サウンド一覧を読み直す'''
+        cls._sound_matcher.reload()
 
     @classmethod
-    async def create_voice(cls, msg: str, user_id: int) -> Path:
-        with cls.SOUND_LINK_FILE.open() as f:
-            sounds = json.loads(f.read())
+    def get_voice_list(cls) -> dict:
+        return cls._voice_list.get()
 
+    @classmethod
+    def prepare_voice(cls, msg: str, user_id: int, guild_id: int = None):
+        '''
+        サウンドの判定と使用回数の記録だけをすぐに行ない、
+        音声を作成するコルーチンを返す関数を返す
+        NOTE: 再生キューで破棄された場合も使用回数には数える
+        '''
         # 全角チルダを波ダッシュに置換
         msg = msg.replace('\uff5e', '\u301c')
 
-        for v in sounds:
-            r = re.fullmatch(f"{v['reg']}", msg, re.I)
-            if r is not None:
-                # 語録使用回数を追加
-                # ファイルを開く
-                with cls.SOUND_LOG_FILE.open() as f:
-                    logs = json.loads(f.read())
-                counts = logs['user_data'].get(str(user_id), [0] * logs['sound_count'])
-                # IDは1から開始しているため-1する
-                sound_id = int(v['id']) - 1
-                counts[sound_id] = counts[sound_id] + 1
-                logs['user_data'][str(user_id)] = counts
-                # 回数を更新して上書き
-                with cls.SOUND_LOG_FILE.open('w') as f:
-                    f.write(json.dumps(logs))
-
-                # もし改行が含まれていたらランダムで選択する
-                link = v['links']
-                links = re.findall(r'^http.*$', link, re.M)
-                if len(links) > 1:
-                    link = random.choice(links)
-                return await cls.create_voice_from_url(link)
-
-        return await cls.create_voice_from_openjtalk(msg, user_id)
+        v = cls._sound_matcher.get().match(msg)
+        if v is not None:
+            # 語録使用回数を追加
+            # NOTE: ファイルへの書き込みはまとめて行なう
+            SoundLog.add(int(v['id']), user_id, guild_id)
+
+            # もし改行が含まれていたらランダムで選択する
+            links = cls.get_sound_links(v)
+            link = random.choice(links) if len(links) > 1 else v['links']
+            return lambda: cls.create_voice_from_url(link)
+
+        return lambda: cls.create_voice_from_openjtalk(msg, user_id)
+
+    @classmethod
+    async def create_voice(
+            cls, msg: str, user_id: int, guild_id: int = None) -> AudioClip:
+        return await cls.prepare_voice(msg, user_id, guild_id)()
+
+    @classmethod
+    def get_clip_cache(cls) -> ClipCache:
+        '''ダウンロードした音声のキャッシュを取得する'''
+        if cls._clip_cache is None:
+            conf = Config.get_global().get('clip_cache', {})
+            cls._clip_cache = ClipCache(
+                Path(conf.get('dir', 'cache/clips')),
+                max_bytes=conf.get('max_mb', 512) * 1024 * 1024,
+                revalidate_after=conf.get('revalidate_sec', 24 * 60 * 60))
+        return cls._clip_cache
+
+    @classmethod
+    def get_utterance_cache(cls) -> UtteranceCache:
+        '''合成した音声のキャッシュを取得する'''
+        if cls._utterance_cache is None:
+            conf = Config.get_global().get('utterance_cache', {})
+            cls._utterance_cache = UtteranceCache(
+                Path(conf.get('dir', 'cache/utterances')),
+                memory_bytes=conf.get('memory_mb', 32) * 1024 * 1024,
+                disk_bytes=conf.get('disk_mb', 256) * 1024 * 1024)
+        return cls._utterance_cache
+
+    @classmethod
+    def get_opus_store(cls) -> OpusStore:
+        '''Ogg Opusへの変換済みファイルの保存先を取得する（無効ならNone）'''
+        if cls._opus_store is None:
+            conf = Config.get_global().get('opus', {})
+            if conf.get('enabled', True) is False:
+                return None
+            cls._opus_store = OpusStore(conf.get('bitrate', 96))
+        return cls._opus_store
 
     @classmethod
-    async def create_voice_from_url(cls, url: str) -> Path:
-        # 拡張子の取得
-        _, ext = os.path.splitext(url)
-        ftime = time.perf_counter()
-        file_name = f'voice_{ftime}'
-        file_path = cls.TEMP_DIR / f'{file_name}{ext}'
-
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as r:
-                if r.status != 200:
-                    # NOTE: いい感じのエラーにする？
-                    return None
-                with file_path.open('wb') as f:
-                    data = await r.read()
-                    f.write(data)
-                return file_path
+    async def create_voice_from_url(
+            cls, url: str, revalidate: bool = False) -> AudioClip:
+        file_path = await cls.get_clip_cache().get(url, force=revalidate)
+        if file_path is None:
+            # NOTE: いい感じのエラーにする？
+            return None
+
+        # NOTE: キャッシュのファイルなので再生後も削除しない
+        store = cls.get_opus_store()
+        if store is not None:
+            opus_path = await store.get(file_path)
+            if opus_path is not None:
+                return AudioClip(opus_path, temporary=False, opus=True)
+        return AudioClip(file_path, temporary=False)
 
     @classmethod
-    async def create_voice_from_openjtalk(cls, t, user_id: int) -> Path:
-        ftime = time.perf_counter()
-        text_file = cls.TEMP_DIR / f'voice_{ftime}.txt'
+    async def create_voice_from_openjtalk(cls, t, user_id: int) -> AudioClip:
         setting = cls.get_user_setting(user_id)
 
-        with text_file.open('w') as f:
-            f.write(t)
-
-        file_name = f'voice_{ftime}'
-        file_path = cls.TEMP_DIR / f'{file_name}.wav'
-
-        with cls.VOICE_LINK_FILE.open() as f:
-            voice_file = json.loads(f.read())
-
-        cmd = [
-            'open_jtalk',
-            '-x', str(cls.DICT_DIR),
-            '-m', str(cls.SYS_VOICE_DIR / f"{voice_file[setting['voice']]}.htsvoice"),
-            '-ow', str(file_path),
-            '-r', str(setting['speed']),
-            '-fm', str(setting['tone']),
-            '-jf', str(setting['intone']),
-            '-u', str(setting['threshold']),
-            # NOTE: Linuxだと音量が無効なオプションと言われるので一旦避難
-            # '-g', str(setting['volume']),
-        ]
-        cmd.append(str(text_file))
-
-        subprocess.run(cmd)
-        text_file.unlink()
-
-        # wav → mp3変換
-        # NOTE: 変換しなくても再生はされるけど警告がめっちゃでる
-        # audio_segment = AudioSegment.from_file(str(wav_file), format='wav')
-        # wav_file.unlink()
-        # audio_segment.export(str(mp3_file), format='mp3')
-
-        return file_path
+        # 同じ文章と声なら合成済みの音声を使う
+        cache = cls.get_utterance_cache()
+        key = cache.make_key(t, setting)
+        pcm = cache.get(key)
+        if pcm is not None:
+            Metrics.inc('cache', 'utterance', 'hit')
+            return AudioClip(pcm=pcm)
+        Metrics.inc('cache', 'utterance', 'miss')
+
+        voice_file = cls.get_voice_list()[setting['voice']]
+        voice_path = cls.SYS_VOICE_DIR / f'{voice_file}.htsvoice'
+        with Metrics.timer('synth'):
+            pcm = await cls.get_backend().synthesize(t, voice_path, setting)
+        if pcm is None:
+            return None
+        cache.put(key, pcm)
+
+        return AudioClip(pcm=pcm)
@@ -0,0 +1,98 @@
+class WordMatcher():
+    '''
+    トライ木による単語置換
+    文頭から一度だけ走査し、最も左で最も長く一致した単語を置換する
+    '''
+
+    # 単語の終端に読みを格納するキー
+    _END = ''
+
+    def __init__(self, words: dict = None):
+        self._root = {}
+        self._size = 0
+        # 登録順の単語と読み
+        self._words = {}
+        if words is not None:
+            for word, read in words.items():
+                self.add(word, read)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __contains__(self, word: str) -> bool:
+        return word in self._words
+
+    def items(self):
+        '''登録されている単語と読みの一覧'''
+        return self._words.items()
+
+    def add(self, word: str, read: str) -> None:
+        '''単語を追加する（登録済みなら読みを上書きする）'''
+        if len(word) < 1:
+            return
+        node = self._root
+        for c in word:
+            node = node.setdefault(c, {})
+        if self._END not in node:
+            self._size += 1
+        node[self._END] = read
+        self._words[word] = read
+
+    def remove(self, word: str) -> bool:
+        '''単語を削除する'''
+        path = []
+        node = self._root
+        for c in word:
+            child = node.get(c)
+            if child is None:
+                return False
+            path.append((node, c))
+            node = child
+        if self._END not in node:
+            return False
+        del node[self._END]
+        del self._words[word]
+        self._size -= 1
+        # 不要になった節を削除する
+        for parent, c in reversed(path):
+            if len(parent[c]) > 0:
+                break
+            del parent[c]
+        return True
+
+    def replace(self, msg: str) -> str:
+        '''登録された単語を読みに置換する'''
+        if self._size < 1:
+            return msg
+
+        root = self._root
+        result = []
+        i = 0
+        n = len(msg)
+        while i < n:
+            node = root.get(msg[i])
+            if node is None:
+                result.append(msg[i])
+                i += 1
+                continue
+
+            # 一番長く一致する単語を探す
+            read = None
+            end = i
+            j = i
+            while node is not None:
+                j += 1
+                if self._END in node:
+                    read = node[self._END]
+                    end = j
+                if j >= n:
+                    break
+                node = node.get(msg[j])
+
+            if read is None:
+                result.append(msg[i])
+                i += 1
+            else:
+                result.append(read)
+                i = end
+        return ''.join(result)
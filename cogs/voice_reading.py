@@ -1,89 +1,123 @@
 import asyncio
 import json
 import re
+import time
 from pathlib import Path
 
 import discord
-import emoji
 from discord.ext import commands
 
-from cogs.utils.msg_util import MessageConverter
+from cogs.utils.channel_util import ChannelResolver
+from cogs.utils.file_cache import FileCache, file_lock, write_atomic
+from cogs.utils.http_util import HttpClient
+from cogs.utils.lazy_module import LazyModule
+from cogs.utils.metrics import Metrics
+from cogs.utils.msg_util import ConvertPipeline, MessageConverter
+from cogs.utils.prewarm import prewarm_sounds
 from cogs.utils.voice_util import VoiceFactory
 from cogs.utils.math_util import MathUtility
+from cogs.utils.session import GuildSession, SessionStore
+from cogs.utils.sound_log import SoundLog
+from cogs.utils.startup import StartupTimer
+from cogs.utils.word_matcher import WordMatcher
 from config import Config
 from setting import GuildSetting, UserSetting
 
+# NOTE: 読み込みに時間がかかるので最初に使う時に読み込む
+emoji = LazyModule('emoji')
+
 
 class VoiceReading(commands.Cog, name='VC読み上げ'):
+    WORDS_FILE = Path('../lunalu-bot/data/json/words.json')
+    # 長い文章を区切る時に途中で切らない部分（URLと英単語）
+    re_protect = re.compile(
+        r'https?://\S+|' + MessageConverter.re_eng.pattern)
+
     def __init__(self, bot):
         self.bot = bot
-        self.target_channel = None
-        self.voice_client = None
+        self.channels = ChannelResolver(bot)
         # 読み上げる文字数
         self.read_char_cnt = 50
 
-        self.words_file = Path('../lunalu-bot/data/json/words.json')
+        self.words_file = self.WORDS_FILE
         if self.words_file.exists() is False:
             with self.words_file.open('w') as f:
                 f.write(r'{}')
-        with self.words_file.open() as f:
-            self.words = json.loads(f.read())
+        # NOTE: 他のプロセスから書き換えられた場合は読み直す
+        self.words = FileCache(self.words_file, self._load_words)
+
+        # 読み上げる文章の変換
+        self.pipeline = ConvertPipeline([
+            # 正規表現置換
+            ('regex', MessageConverter.replace_by_re),
+            # ユーザー辞書変換
+            ('words', lambda m: self.words.get().replace(m)),
+            ('emoji', lambda m: emoji.demojize(m)),
+            # 英語かな変換
+            ('eng_kana', MessageConverter.replace_eng_to_kana),
+            # ローマ字かな変換
+            ('roman_kana', MessageConverter.replace_roman_to_kana),
+        ], whole=('regex',), protect=self.re_protect)
 
         self.sefifs_file = Path('./data/json/serifs.json')
-        with self.sefifs_file.open() as f:
-            self.serifs = json.loads(f.read())
-
-    async def __leave_voice_channel(self):
+        self.serifs = FileCache(
+            self.sefifs_file, lambda p: json.loads(p.read_text()))
+        self._warm_up_task = None
+
+    def cog_unload(self):
+        # ダウンロード用の共有セッションを閉じる
+        self.bot.loop.create_task(HttpClient.close())
+
+    def _warm_up(self) -> None:
+        '''最初の読み上げが遅くならないように辞書などを読み込んでおく'''
+        emoji.demojize('')
+        # NOTE: 英語かな変換の索引がなければここで作成する
+        MessageConverter.replace_eng_to_kana('warm up')
+        MessageConverter.replace_roman_to_kana('warm up')
+        MessageConverter.re_rules.get()
+        self.words.get()
+        self.serifs.get()
+        VoiceFactory.get_sound_list()
+        VoiceFactory.get_voice_list()
+
+    async def __warm_up(self) -> None:
+        start = time.perf_counter()
+        try:
+            # NOTE: イベントループを止めないように別スレッドで読み込む
+            await asyncio.get_event_loop().run_in_executor(None, self._warm_up)
+        except Exception as e:
+            print(f'Warm up error : {e}')
+        StartupTimer.add('warm_up', time.perf_counter() - start)
+        StartupTimer.mark('warm_up')
+
+    async def __leave_voice_channel(self, session: GuildSession):
         # VoiceClientが空なら処理しない
-        if self.voice_client is None:
+        if session.voice_client is None:
             return
 
         # VCに接続していたら切断する
-        if self.voice_client.is_connected():
-            await self.voice_client.disconnect()
-        self.voice_client = None
+        if session.voice_client.is_connected():
+            await session.voice_client.disconnect()
+        session.detach()
 
-        await self.target_channel.send(self.get_serif("leave_voice_channel"))
-        self.target_channel = None
+        await session.target_channel.send(self.get_serif("leave_voice_channel"))
+        session.set_target(None)
+        SessionStore.remove(session.guild_id)
 
     def _convert_message(
             self, msg: str, max_length=0) -> str:
-        _msg = msg
-        # 正規表現置換
-        _msg = MessageConverter.replace_by_re(_msg)
-        self._load_words()
-        # ユーザー辞書変換
-        for (pre, post) in self.words.items():
-            # _pre = pre.lower()
-            if pre in _msg:
-                _msg = _msg.replace(pre, post)
-        _msg = emoji.demojize(_msg)
-        # 英語かな変換
-        _msg = MessageConverter.replace_eng_to_kana(_msg)
-        # ローマ字かな変換
-        _msg = MessageConverter.replace_roman_to_kana(_msg)
-
-        # 長い文章はカットする
-        if max_length != 0:
-            if len(_msg) > max_length:
-                _msg = _msg[:max_length] + '以下略'
-
-        return _msg
-
-    def _update_word(self) -> None:
-        '''単語の更新'''
-        _list = sorted(self.words.items(),
-                       key=lambda x: len(x[0]), reverse=True)
-        d = {}
-        for k, v in _list:
-            d[k] = v
-        self.words = d
-        with self.words_file.open('w') as f:
-            f.write(json.dumps(self.words, ensure_ascii=False, indent=4))
-
-    def _load_words(self) -> None:
-        with self.words_file.open() as f:
-            self.words = json.loads(f.read())
+        return self.pipeline.run(msg, max_length)
+
+    def _update_word(self, matcher: WordMatcher) -> None:
+        '''単語の更新（file_lockの中で呼ぶ）'''
+        write_atomic(
+            self.words_file,
+            json.dumps(dict(matcher.items()), ensure_ascii=False, indent=4))
+        self.words.update(matcher)
+
+    def _load_words(self, path: Path) -> WordMatcher:
+        with path.open() as f:
+            return WordMatcher(json.loads(f.read()))
 
     def _set_status(self, user_id, status: str, param) -> None:
         '''ユーザー設定にパラメータを設定'''
@@ -133,7 +167,7 @@ class VoiceReading(commands.Cog, name='VC読み上げ'):
     async def voice(self, ctx):
         '''読み上げ音声に関する設定を行えるわ'''
         if ctx.invoked_subcommand is None:
-            await ctx.channel.send(f'コマンドが間違っているわ…\n例えば、声のトーンを変更したい時は\n`{config.COMMAND_PREFIX}voice tone -20~20の数値` と入力してみて')
+            await ctx.channel.send(f'コマンドが間違っているわ…\n例えば、声のトーンを変更したい時は\n`{ctx.prefix}voice tone -20~20の数値` と入力してみて')
 
     @voice.command()
     async def status(self, ctx):
@@ -211,9 +245,13 @@ class VoiceReading(commands.Cog, name='VC読み上げ'):
         if _flg:
             watch_channel_id['voice'] = voice_state.channel.id
             watch_channel_id['text'] = ctx.channel.id
+            # チャンネルが削除された時に通知する相手
+            watch_channel_id['owner'] = ctx.author.id
         else:
             watch_channel_id['voice'] = 0
             watch_channel_id['text'] = 0
+            watch_channel_id.pop('owner', None)
+        watch_channel_id.pop('notified', None)
 
         GuildSetting.update_setting(ctx.guild.id, conf)
 
@@ -227,17 +265,17 @@ class VoiceReading(commands.Cog, name='VC読み上げ'):
             self,
             text_channel: discord.TextChannel,
             voice_channel: discord.VoiceChannel) -> None:
+        session = SessionStore.get_or_create(voice_channel.guild.id)
         # VoiceClientが空またはVCに未接続なら接続
-        if self.voice_client is None:
-            self.voice_client = await voice_channel.connect()
-        if self.voice_client.is_connected() is False:
-            await self.voice_client.connect(timeout=3000, reconnect=False)
+        if session.voice_client is None:
+            session.attach(await voice_channel.connect())
+        if session.voice_client.is_connected() is False:
+            await session.voice_client.connect(timeout=3000, reconnect=False)
 
-        if self.target_channel is None or\
-                self.target_channel.id != text_channel.id:
+        if session.is_target(text_channel) is False:
             await text_channel.send(
                 self.get_serif('start_reading', text_channel.mention))
-            self.target_channel = text_channel
+            session.set_target(text_channel)
         # else:
         #     await text_channel.send(
         #         self.get_serif('already_reading', text_channel.mention))
@@ -254,29 +292,66 @@ class VoiceReading(commands.Cog, name='VC読み上げ'):
     async def bye(self, ctx):
         '''VCから私を切断することができるわ'''
         # VoiceClientが空またはVCに未接続ならエラーメッセージ
-        if self.voice_client is None:
+        session = SessionStore.get(ctx.guild.id)
+        if session is None or session.voice_client is None:
             return
 
-        if self.voice_client.is_connected() is False:
-            await ctx.channel.send(f"VCにいないわ…\n私をVCに呼びたいときは`{Config.get_prefix()}join`と入力して")
+        if session.is_connected() is False:
+            await ctx.channel.send(f"VCにいないわ…\n私をVCに呼びたいときは`{ctx.prefix}join`と入力して")
             return
 
         await ctx.message.add_reaction('👋')
-        await self.__leave_voice_channel()
+        await self.__leave_voice_channel(session)
 
     @commands.command(aliases=['st'])
     async def stop(self, ctx):
-        '''読み上げ中の音声を停止するわ'''
+        '''読み上げ中の音声を停止して、読み上げ待ちの音声も破棄するわ'''
         # 参加中のVCがなければメッセージを返す
-        if self.voice_client is None or\
-                self.voice_client.is_connected() is False:
+        session = SessionStore.get(ctx.guild.id)
+        if session is None or session.is_connected() is False:
             await ctx.channel.send('何も喋ってないわ。作業に集中しましょ')
             return
 
-        # 再生中なら止める
-        if self.voice_client.is_playing():
+        # 再生待ちを破棄してから再生中の音声を止める
+        cleared = session.queue.clear()
+        if session.queue.skip() or cleared > 0:
             await ctx.message.add_reaction('⏹')
-            self.voice_client.stop()
+
+    @commands.command()
+    async def skip(self, ctx):
+        '''読み上げ中の音声を飛ばして次を読み上げるわ'''
+        session = SessionStore.get(ctx.guild.id)
+        if session is None or session.is_connected() is False:
+            await ctx.channel.send('何も喋ってないわ。作業に集中しましょ')
+            return
+
+        if session.queue.skip():
+            await ctx.message.add_reaction('⏭')
+
+    @commands.command(aliases=['q'])
+    async def queue(self, ctx):
+        '''読み上げ待ちの状況を表示するわ'''
+        session = SessionStore.get(ctx.guild.id)
+        if session is None or session.is_connected() is False:
+            await ctx.channel.send('何も喋ってないわ。作業に集中しましょ')
+            return
+
+        queue = session.queue
+        # NOTE: 合成のプールは全サーバーで共有している
+        backend = VoiceFactory.get_backend()
+        status_list = [
+            f'再生中　　： {"あり" if queue.is_playing() else "なし"}',
+            f'再生待ち　： {len(queue)} / {queue.max_depth}',
+            f'待ち時間　： 約{queue.wait_time():.1f}秒',
+            f'合成中　　： {queue.preparing()}',
+            f'破棄した数： {queue.dropped}',
+            f'音声の間隔： 平均{queue.gaps.average:.2f}秒 / 最大{queue.gaps.max:.2f}秒',
+            f'先読み成功： {queue.gaps.ready} / {queue.gaps.count}',
+            f'合成待ち　： {backend.queue_depth}（実行中 {backend.running} / {backend.size}）',
+        ]
+        embed = discord.Embed(color=Config.get_global()['embed_color'])
+        embed.add_field(name='読み上げキュー', value='\n'.join(status_list))
+        await ctx.channel.send(embed=embed)
 
     @commands.command(usage='読みを追加したい単語 読み', aliases=['word_add'])
     async def wa(self, ctx, *args) -> None:
@@ -288,8 +363,11 @@ class VoiceReading(commands.Cog, name='VC読み上げ'):
             de_custom_emoji = re.compile(r"<:(\w+):\d+>")
             word = de_custom_emoji.sub(r'\1', args[0])
             read = de_custom_emoji.sub(r'\1', args[1])
-            self.words[word] = read
-            self._update_word()
+            # NOTE: 他のシャードの変更を消さないように読み直してから書き込む
+            with file_lock(self.words_file):
+                matcher = self.words.get()
+                matcher.add(word, read)
+                self._update_word(matcher)
             await ctx.channel.send(
                 self.get_serif('complete_word_add', args[0], read))
         else:
@@ -306,8 +384,15 @@ class VoiceReading(commands.Cog, name='VC読み上げ'):
         if len(args) == 1:
             de_custom_emoji = re.compile(r"<:(\w+):\d+>")
             word = de_custom_emoji.sub(r'\1', args[0])
-            del self.words[word]
-            self._update_word()
+            with file_lock(self.words_file):
+                matcher = self.words.get()
+                removed = matcher.remove(word)
+                if removed:
+                    self._update_word(matcher)
+            if removed is False:
+                await ctx.channel.send(
+                    self.get_serif('error_word_delete', ctx.prefix))
+                return
             await ctx.channel.send(
                 self.get_serif('complete_word_delete', args[0]))
         else:
@@ -319,8 +404,7 @@ class VoiceReading(commands.Cog, name='VC読み上げ'):
     async def wl(self, ctx) -> None:
         '''登録されている単語の読み一覧を表示するわ'''
         word_list = [f"{self.get_serif('show_word_list')}\n単語（読み）"]
-        self._load_words()
-        for (word, read) in self.words.items():
+        for (word, read) in self.words.get().items():
             word_list.append(f'・{word}（{read}）')
         await ctx.channel.send('\n'.join(word_list))
 
@@ -330,6 +414,82 @@ class VoiceReading(commands.Cog, name='VC読み上げ'):
         msg = "音源はこのスプレッドシートに記載されているわ\nhttps://docs.google.com/spreadsheets/d/1_P_o1PGRqv_8Wdcpqj_Nd9rd-cRohsolUMuENbAxVi8/edit?usp=sharing"
         await ctx.channel.send(msg)
 
+    @commands.command(aliases=['sound_rank'])
+    async def sr(self, ctx) -> None:
+        '''
+        よく使われているサウンドを表示するわ
+        -sr @ユーザー でその人がよく使うサウンドを表示できるわ
+        '''
+        if len(ctx.message.mentions) > 0:
+            target = ctx.message.mentions[0]
+            ranking = SoundLog.top(user_id=target.id)
+            title = f'{target.display_name} さんがよく使うサウンド'
+        else:
+            ranking = SoundLog.top(guild_id=ctx.guild.id)
+            title = f'{ctx.guild.name} でよく使われているサウンド'
+
+        if len(ranking) < 1:
+            await ctx.channel.send('まだサウンドが使われていないわ')
+            return
+
+        names = {int(v['id']): v.get('name', v['reg'])
+                 for v in VoiceFactory.get_sound_list()}
+        rank_list = [f'{i + 1}. {names.get(sound_id, sound_id)}（{count}回）'
+                     for i, (sound_id, count) in enumerate(ranking)]
+        embed = discord.Embed(color=Config.get_global()['embed_color'])
+        embed.add_field(name=title, value='\n'.join(rank_list))
+        await ctx.channel.send(embed=embed)
+
+    @commands.command()
+    @commands.is_owner()
+    async def cache(self, ctx) -> None:
+        '''キャッシュの使用状況を表示するわ'''
+        utterance = VoiceFactory.get_utterance_cache()
+        clip = VoiceFactory.get_clip_cache()
+        status_list = [
+            f'合成音声のヒット率： {utterance.hit_rate * 100:.1f}%',
+            f'　メモリ　　　　　： {utterance.memory_hits}回',
+            f'　ディスク　　　　： {utterance.disk_hits}回',
+            f'　ミス　　　　　　： {utterance.misses}回',
+            f'サウンドのヒット　： {clip.hits}回',
+            f'サウンドのミス　　： {clip.misses}回',
+        ]
+        embed = discord.Embed(color=Config.get_global()['embed_color'])
+        embed.add_field(name='キャッシュ', value='\n'.join(status_list))
+        await ctx.channel.send(embed=embed)
+
+    @commands.command()
+    @commands.is_owner()
+    async def prewarm(self, ctx, parallel: int = 4) -> None:
+        '''全サウンドを事前に取得しておくわ'''
+        await ctx.message.add_reaction('⏳')
+        report = await prewarm_sounds(parallel)
+        # NOTE: 失敗が多いと文字数制限を超えるので切り詰める
+        await ctx.channel.send(f'```\n{report.summary()[:1900]}\n```')
+
+    @commands.command()
+    @commands.is_owner()
+    async def reload(self, ctx) -> None:
+        '''辞書や設定ファイルを読み直すわ'''
+        Config.reload()
+        MessageConverter.reload()
+        self.words.reload()
+        self.serifs.reload()
+        VoiceFactory.reload_sounds()
+        await ctx.message.add_reaction('🔄')
+
+    @commands.command()
+    @commands.is_owner()
+    async def startup(self, ctx) -> None:
+        '''起動にかかった時間を表示するわ'''
+        await ctx.channel.send(f'```\n{StartupTimer.report()}\n```')
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # NOTE: 再接続でも呼ばれるので一度だけ行なう
+        if self._warm_up_task is None:
+            self._warm_up_task = asyncio.ensure_future(self.__warm_up())
+
     @commands.Cog.listener()
     async def on_voice_state_update(
             self, member: discord.Member,
@@ -342,15 +502,13 @@ class VoiceReading(commands.Cog, name='VC読み上げ'):
         if before.channel == after.channel:
             return
 
-        if self.voice_client is not None:
+        session = SessionStore.get(member.guild.id)
+        if session is not None and session.voice_client is not None:
             # VCに接続済みの場合の動作
-            if self.voice_client.is_connected():
-                # 関係のないサーバーは無視
-                if member.guild != self.target_channel.guild:
-                    return
+            if session.is_connected():
                 # 参加者がbotのみになったら退出
-                if len([1 for user in self.voice_client.channel.members if not user.bot]) < 1:
-                    await self.__leave_voice_channel()
+                if len([1 for user in session.voice_client.channel.members if not user.bot]) < 1:
+                    await self.__leave_voice_channel(session)
 
         # VCに未接続の場合の動作
         else:
@@ -368,74 +526,96 @@ class VoiceReading(commands.Cog, name='VC読み上げ'):
             # 自動参加チャンネルIDが設定されていたら接続する
             channel_id = watch_channel_id['text']
             if channel_id != 0:
-                try:
-                    _target_channel = await self.bot.fetch_channel(channel_id)
-                    # ※暫定対策のため、後ほど削除
-                    # 読み上げ対象のチャンネルが対象のサーバーでない場合は無視
-                    if _target_channel.guild != member.guild:
-                        return
-                except Exception:
-                    # TODO: auto_join設定者に対して再設定をうながす通知
+                _target_channel = await self.channels.resolve(channel_id)
+                if _target_channel is None:
+                    # NOTE: APIの一時的なエラーでは通知しない
+                    if self.channels.is_missing(channel_id):
+                        await self.__notify_auto_join_missing(member.guild, conf)
+                    return
+                # チャンネルが取得できたら、次に消えた時にまた通知する
+                if watch_channel_id.pop('notified', None) is not None:
+                    GuildSetting.update_setting(member.guild.id, conf)
+                # ※暫定対策のため、後ほど削除
+                # 読み上げ対象のチャンネルが対象のサーバーでない場合は無視
+                if _target_channel.guild != member.guild:
                     return
-                else:
-                    # VCに接続
-                    await self.__join(_target_channel, after.channel)
+                # VCに接続
+                await self.__join(_target_channel, after.channel)
+
+    async def __notify_auto_join_missing(
+            self, guild: discord.Guild, conf: dict) -> None:
+        '''自動参加の読み上げチャンネルが消えていることを設定者に一度だけ通知する'''
+        watch_channel_id = conf['watch_channel_id']
+        owner_id = watch_channel_id.get('owner')
+        if owner_id is None or watch_channel_id.get('notified', False):
+            return
+
+        watch_channel_id['notified'] = True
+        GuildSetting.update_setting(guild.id, conf)
+
+        owner = self.bot.get_user(owner_id)
+        try:
+            if owner is None:
+                owner = await self.bot.fetch_user(owner_id)
+            await owner.send(
+                self.get_serif('auto_join_channel_missing', guild.name))
+        except discord.HTTPException:
+            pass
 
     @commands.Cog.listener()
     async def on_message(self, message: discord.Message):
-        # コマンドは読み上げない
-        if message.content.startswith(Config.get_prefix()):
+        # 読み上げ対象のチャンネル以外は何もせずに無視する
+        # NOTE: DMも含めて全てのメッセージが来るので最初に判定する
+        if message.guild is None or\
+                SessionStore.is_watched(message.guild.id, message.channel.id) is False:
             return
 
         # botの発言は読み上げない
         if message.author.bot:
             return
 
-        if self.target_channel is None:
-            conf = GuildSetting.get_setting(message.guild.id)
-            channel_id = conf['watch_channel_id']['text']
-            self.target_channel = await self.bot.fetch_channel(channel_id)
+        # コマンドは読み上げない
+        if message.content.startswith(Config.get_prefix(message.guild.id)):
+            return
 
-        # 読み上げ対象のチャンネル以外は読み上げない
-        if message.channel != self.target_channel:
+        session = SessionStore.get(message.guild.id)
+        if session is None:
             return
 
-        vc = self.voice_client
+        vc = session.voice_client
         if vc is None:
             return
         if vc.is_connected() is False:
             conf = GuildSetting.get_setting(message.guild.id)
             channel_id = conf['watch_channel_id']['voice']
-            voice_channel = self.bot.get_channel(channel_id)
-            await self.__join(self.target_channel, voice_channel)
+            voice_channel = await self.channels.resolve(channel_id)
+            if voice_channel is None:
+                return
+            await self.__join(session.target_channel, voice_channel)
 
         msg = message.clean_content
         if message.content.startswith('=sc '):
             msg = f"{message.author.display_name}さんがスパチャしました。{msg[4:]}"
-        msg = self._convert_message(msg, self.read_char_cnt)
-        vf = await VoiceFactory.create_voice(msg, message.author.id)
-        if vf is None:
+        user_id = message.author.id
+        guild_id = message.guild.id
+        with Metrics.timer('convert', guild_id=guild_id):
+            msg = self._convert_message(msg, self.read_char_cnt)
+        # NOTE: 切断などでセッションが破棄されていたら再生しない
+        if session.queue is None:
             return
-        # 一定時間だけ再生を試みる
-        for _ in range(600):
-            try:
-                vc.play(
-                    discord.FFmpegPCMAudio(str(vf)),
-                    after=lambda e: vf.unlink())
-                break
-            except discord.ClientException:
-                await asyncio.sleep(0.2)
-        else:
-            print(f"Play canceled : {message.clean_content}")
-            vf.unlink()
-            # await self.target_channel.send("長い文章を読み上げているから読み上げをやめるわ")
+        # NOTE: サウンドの判定と使用回数の記録はここで行ない、
+        #       音声の作成（ダウンロードや合成）は再生キューが先読みで行なう
+        session.queue.put(
+            VoiceFactory.prepare_voice(msg, user_id, guild_id),
+            message.clean_content)
 
     def get_serif(self, name: str, *args) -> str:
         '''セリフを取得'''
-        if name not in self.serifs:
+        serifs = self.serifs.get()
+        if name not in serifs:
             return ''
 
-        serif = self.serifs[name]
+        serif = serifs[name]
         if len(args) < 1:
             return serif
         else:
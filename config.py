@@ -1,24 +1,50 @@
 import json
 import os
+from types import MappingProxyType
 from dotenv import load_dotenv
 from pathlib import Path
 
 load_dotenv()
 
 
+def _freeze(value):
+    '''書き換えられないようにdictとlistを読み取り専用にする'''
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
 class Config():
     CONFIG_PATH = Path('config')
+    # 読み込み済みの全体設定（読み取り専用）
+    _global = None
 
     @classmethod
-    def get_global(cls) -> dict:
-        '''全体の設定を取得する'''
+    def reload(cls) -> None:
+        '''設定ファイルを読み直す'''
         path = cls.CONFIG_PATH / "global.json"
         with path.open() as f:
-            return json.loads(f.read())
+            # NOTE: 読み込み途中の状態が見えないように丸ごと差し替える
+            cls._global = _freeze(json.loads(f.read()))
+
+    @classmethod
+    def get_global(cls) -> MappingProxyType:
+        '''全体の設定を取得する'''
+        if cls._global is None:
+            cls.reload()
+        return cls._global
 
     @classmethod
-    def get_prefix(cls) -> str:
-        return cls.get_global()['prefix']
+    def get_prefix(cls, guild_id: int = None) -> str:
+        '''コマンドのプレフィックスを取得する（サーバーごとの設定を優先する）'''
+        conf = cls.get_global()
+        if guild_id is not None:
+            prefix = conf.get('guild_prefixes', {}).get(str(guild_id))
+            if prefix is not None:
+                return prefix
+        return conf['prefix']
 
     @classmethod
     def get_token(cls) -> str:
@@ -0,0 +1,157 @@
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import time
+
+from config import Config
+
+# 起動してからこの秒数以上動いていたら、再起動の待ち時間を元に戻す
+STABLE_SEC = 60.0
+
+
+class Shard():
+    '''1つのシャードを動かすプロセス'''
+
+    def __init__(self, shard_id: int, shard_count: int):
+        self.shard_id = shard_id
+        self.shard_count = shard_count
+        self.proc = None
+        self.started_at = 0.0
+        # 再起動するまでの待ち時間（落ちるたびに倍にする）
+        self.backoff = 1.0
+        self.restart_at = None
+        self.restarts = 0
+
+    def start(self) -> None:
+        cmd = [
+            sys.executable, 'main.py',
+            '--shard-id', str(self.shard_id),
+            '--shard-count', str(self.shard_count),
+        ]
+        self.proc = subprocess.Popen(cmd)
+        self.started_at = time.monotonic()
+        self.restart_at = None
+        print(f'Shard {self.shard_id}: started (pid {self.proc.pid})')
+
+    def is_running(self) -> bool:
+        return self.proc is not None and self.proc.poll() is None
+
+    def signal(self, sig) -> None:
+        if self.is_running():
+            self.proc.send_signal(sig)
+
+
+class Supervisor():
+    '''
+    シャードごとにプロセスを起動し、落ちたシャードだけを再起動する
+    NOTE: Discordの接続（IDENTIFY）は5秒に1回までなので、間隔を空けて起動する
+    '''
+
+    def __init__(
+            self, shard_count: int, identify_interval: float = 5.5,
+            max_backoff: float = 300.0):
+        self.shards = [Shard(i, shard_count) for i in range(shard_count)]
+        self.identify_interval = identify_interval
+        self.max_backoff = max_backoff
+        self._last_start = 0.0
+        self._stopping = False
+
+    def _start(self, shard: Shard) -> None:
+        # 前のシャードの起動から間隔を空ける
+        wait = self._last_start + self.identify_interval - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        shard.start()
+        self._last_start = time.monotonic()
+
+    def _check(self, shard: Shard) -> None:
+        if shard.proc is None or shard.is_running():
+            return
+        now = time.monotonic()
+        if shard.restart_at is None:
+            code = shard.proc.returncode
+            if code == 0:
+                # NOTE: 正常に終了した場合は再起動しない
+                print(f'Shard {shard.shard_id}: stopped')
+                shard.proc = None
+                return
+            if now - shard.started_at >= STABLE_SEC:
+                shard.backoff = 1.0
+            shard.restart_at = now + shard.backoff
+            print(f'Shard {shard.shard_id}: exited ({code}), '
+                  f'restarting in {shard.backoff:.0f}s')
+            shard.backoff = min(shard.backoff * 2, self.max_backoff)
+        elif now >= shard.restart_at:
+            shard.restarts += 1
+            self._start(shard)
+
+    def stop(self, *args) -> None:
+        '''全てのシャードを終了させる'''
+        self._stopping = True
+
+    def reload(self, *args) -> None:
+        '''全てのシャードに設定を読み直させる'''
+        for shard in self.shards:
+            shard.signal(signal.SIGHUP)
+
+    def run(self) -> int:
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, self.reload)
+
+        for shard in self.shards:
+            if self._stopping:
+                break
+            self._start(shard)
+
+        while self._stopping is False:
+            for shard in self.shards:
+                self._check(shard)
+            if all(shard.proc is None for shard in self.shards):
+                return 0
+            time.sleep(1.0)
+
+        # NOTE: SIGTERMで各シャードが設定などを書き出してから終了する
+        for shard in self.shards:
+            shard.signal(signal.SIGTERM)
+        deadline = time.monotonic() + 30.0
+        for shard in self.shards:
+            if shard.proc is None:
+                continue
+            try:
+                shard.proc.wait(max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                print(f'Shard {shard.shard_id}: killed')
+                shard.proc.kill()
+        return 0
+
+
+# Botを複数のプロセスに分けて起動する
+if __name__ == '__main__':
+    conf = Config.get_global().get('shards', {})
+    parser = argparse.ArgumentParser(description='シャードごとにプロセスを分けてBotを起動する')
+    parser.add_argument('-n', '--shards', type=int,
+                        default=conf.get('count', 0),
+                        help='シャードの数（0ならCPUのコア数）')
+    args = parser.parse_args()
+
+    if Config.get_global().get('setting_backend', 'json') != 'sqlite':
+        print('NOTE: setting_backend is not "sqlite". '
+              'JSON settings are rewritten as a whole on every save.')
+
+    # NOTE: 各シャードで作成しないように英語かな変換の索引を先に作成しておく
+    #       （作成時は元の辞書を読むのでメモリを使う。別プロセスで作成する）
+    subprocess.run([
+        sys.executable, '-c',
+        'from cogs.utils.msg_util import MessageConverter;'
+        'MessageConverter.get_eng_kana_index()'])
+
+    count = args.shards if args.shards > 0 else (os.cpu_count() or 1)
+    supervisor = Supervisor(
+        count,
+        identify_interval=conf.get('identify_interval_sec', 5.5),
+        max_backoff=conf.get('max_backoff_sec', 300))
+    sys.exit(supervisor.run())
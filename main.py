@@ -1,43 +1,104 @@
+import argparse
 import os
+import signal
+import time
 import traceback
 
+# NOTE: 起動時間を計測するので最初に読み込む
+from cogs.utils.startup import StartupTimer
+
 import discord
 from discord.ext import commands
 from pathlib import Path
 
+from cogs.utils.http_util import HttpClient
+from cogs.utils.metrics import Metrics
+from cogs.utils.sound_log import SoundLog
+from cogs.utils.voice_util import VoiceFactory
 from config import Config
+from setting import GuildSetting, UserSetting
 import extentions
 
+StartupTimer.mark('import')
+
+
+# サーバーごとのプレフィックスを返す
+def get_prefix(bot, message):
+    guild_id = message.guild.id if message.guild is not None else None
+    return Config.get_prefix(guild_id)
+
 
 # Botクラス
 class Lunalu(commands.Bot):
-    def __init__(self):
+    # shard_idを指定した場合はそのシャードのサーバーだけを担当する
+    def __init__(self, shard_id: int = None, shard_count: int = None):
         super().__init__(
-            command_prefix=Config.get_prefix(),
-            fetch_offline_members=False
+            command_prefix=get_prefix,
+            fetch_offline_members=False,
+            shard_id=shard_id,
+            shard_count=shard_count
         )
 
         # 拡張機能の読み込み
         for extention in extentions.extentions:
+            start = time.perf_counter()
             try:
                 self.load_extension(f'cogs.{extention}')
             except Exception:
                 traceback.print_exc()
+            StartupTimer.add(f'cog:{extention}', time.perf_counter() - start)
+        StartupTimer.mark('cog_setup')
 
     # 起動時のイベント
     async def on_ready(self):
-        print(f'Ready: {self.user} (ID: {self.user.id})')
-        activity = discord.Game(f'({self.command_prefix}) VC読み上げ')
+        print(f'Ready: {self.user} (ID: {self.user.id}, Shard: {self.shard_id})')
+        if StartupTimer.mark('ready'):
+            print(StartupTimer.report())
+        activity = discord.Game(f'({Config.get_prefix()}) VC読み上げ')
         await self.change_presence(activity=activity)
 
+    # 起動時の処理
+    async def start(self, *args, **kwargs):
+        # ダウンロード用の共有セッションを作成する
+        HttpClient.get_session()
+        # SIGHUPで設定ファイルを読み直す
+        if hasattr(signal, 'SIGHUP'):
+            self.loop.add_signal_handler(signal.SIGHUP, Config.reload)
+        # 計測値を返すHTTPサーバーを起動する
+        conf = Config.get_global().get('metrics', {})
+        if conf.get('enabled', False):
+            # NOTE: シャードごとに別のポートで待ち受ける
+            port = conf.get('port', 9108) + (self.shard_id or 0)
+            await Metrics.start_server(conf.get('host', '127.0.0.1'), port)
+        await super().start(*args, **kwargs)
+
+    # 終了時の処理
+    async def close(self):
+        await super().close()
+        await HttpClient.close()
+        await Metrics.stop_server()
+        VoiceFactory.close_backend()
+        # メモリ上の設定をファイルに書き出す
+        GuildSetting.flush()
+        UserSetting.flush()
+        SoundLog.flush()
+
     # Botを起動させる
     def run(self):
         super().run(Config.get_token())
 
 
-# Botの作成
-bot = Lunalu()
+def parse_args():
+    parser = argparse.ArgumentParser(description='Lunalu')
+    parser.add_argument('--shard-id', type=int, default=None,
+                        help='担当するシャードの番号（launcher.pyから指定される）')
+    parser.add_argument('--shard-count', type=int, default=None,
+                        help='シャードの総数')
+    return parser.parse_args()
+
 
 # Botの起動
 if __name__ == '__main__':
+    args = parse_args()
+    bot = Lunalu(args.shard_id, args.shard_count)
     bot.run()
@@ -0,0 +1,24 @@
+import argparse
+import asyncio
+import sys
+
+from cogs.utils.http_util import HttpClient
+from cogs.utils.prewarm import prewarm_sounds
+
+
+# サウンドを事前に取得する
+async def main(parallel: int) -> int:
+    try:
+        report = await prewarm_sounds(parallel)
+    finally:
+        await HttpClient.close()
+    print(report.summary())
+    return 1 if len(report.failed) > 0 else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='サウンドのキャッシュを作成する')
+    parser.add_argument('-p', '--parallel', type=int, default=4,
+                        help='同時に取得する数')
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main(args.parallel)))
@@ -1,53 +1,298 @@
+import atexit
 import json
+import os
+import sqlite3
+import threading
+from copy import deepcopy
 from pathlib import Path
 
+from cogs.utils.file_cache import file_lock, write_atomic
+from config import Config
+
 SETTING_PATH = Path('settings')
 
 
+def _file_version(path: Path) -> tuple:
+    '''ファイルが置き換えられたかどうかの判定に使う値'''
+    try:
+        st = os.stat(str(path))
+    except FileNotFoundError:
+        return None
+    # NOTE: write_atomicで置き換えるとinodeが変わる
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+class JsonBackend():
+    '''設定をJSONファイルに保存する'''
+
+    def __init__(self, path: Path):
+        self.path = path
+
+    def load(self) -> dict:
+        with self.path.open() as f:
+            return json.loads(f.read())
+
+    def version(self) -> tuple:
+        '''他のプロセスが書き込んだかどうかの判定に使う値'''
+        return _file_version(self.path)
+
+    def save(self, data: dict, keys: set, version) -> tuple:
+        '''
+        変更したキーを書き込み、(書き込んだ後の全設定, バージョン) を返す
+        '''
+        # NOTE: 他のプロセスの変更を消さないように、読み直して変更したキーだけ反映する
+        with file_lock(self.path):
+            current = self.load() if self.path.exists() else {}
+            current.update({k: data[k] for k in keys if k in data})
+            write_atomic(
+                self.path, json.dumps(current, ensure_ascii=True, indent=4))
+            return (current, self.version())
+
+
+class SqliteBackend():
+    '''
+    設定をSQLiteに保存する
+    変更のあったキーだけを書き込むので、件数が多い場合に向いている
+    '''
+    # テーブルごとの書き込み回数（他のプロセスが書き込んだかどうかの判定に使う）
+    VERSION_TABLE = 'setting_versions'
+
+    def __init__(self, path: Path, table: str, source: Path = None):
+        self.path = path
+        self.table = table
+        # 初回作成時に取り込むJSONファイル
+        self.source = source
+        self._conn = None
+
+    def _connect(self) -> sqlite3.Connection:
+        # NOTE: 書き込みはタイマーのスレッドから行なう。SettingStoreの_io_lock内でだけ使う
+        if self._conn is None:
+            conn = sqlite3.connect(
+                str(self.path), timeout=10,
+                isolation_level=None, check_same_thread=False)
+            conn.execute(
+                f'CREATE TABLE IF NOT EXISTS {self.table} '
+                '(id TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            conn.execute(
+                f'CREATE TABLE IF NOT EXISTS {self.VERSION_TABLE} '
+                '(name TEXT PRIMARY KEY, version INTEGER NOT NULL)')
+            self._conn = conn
+        return self._conn
+
+    def load(self) -> dict:
+        rows = self._connect().execute(
+            f'SELECT id, value FROM {self.table}').fetchall()
+        if len(rows) < 1 and self.source is not None and self.source.exists():
+            data = JsonBackend(self.source).load()
+            self.save(data, set(data.keys()), self.version())
+            return data
+        return {k: json.loads(v) for k, v in rows}
+
+    def version(self) -> int:
+        '''他のプロセスが書き込んだかどうかの判定に使う値'''
+        row = self._connect().execute(
+            f'SELECT version FROM {self.VERSION_TABLE} WHERE name = ?',
+            (self.table,)).fetchone()
+        return row[0] if row is not None else 0
+
+    def save(self, data: dict, keys: set, version) -> tuple:
+        '''
+        変更したキーを書き込み、(全設定, バージョン) を返す
+        他のプロセスが先に書き込んでいた場合はバージョンをNoneにする（次回読み直す）
+        '''
+        rows = [(k, json.dumps(data[k], ensure_ascii=True))
+                for k in keys if k in data]
+        conn = self._connect()
+        # NOTE: 書き込みロックを取ってからバージョンを確認する
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            current = self.version()
+            conn.executemany(
+                f'INSERT OR REPLACE INTO {self.table} (id, value) VALUES (?, ?)',
+                rows)
+            conn.execute(
+                f'INSERT OR REPLACE INTO {self.VERSION_TABLE} (name, version) '
+                'VALUES (?, ?)', (self.table, current + 1))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return (data, current + 1 if current == version else None)
+
+
+class SettingStore():
+    '''
+    設定をメモリ上に保持し、変更はまとめて書き込む
+    書き込みは最初の変更からdelay秒後に行なう
+    他のプロセスが書き込んでいたら読み直す
+    '''
+
+    def __init__(self, backend, delay: float = 2.0):
+        self.backend = backend
+        self.delay = delay
+        self._data = None
+        self._version = None
+        self._dirty = set()
+        # 書き込み中のキー
+        self._saving = set()
+        self._timer = None
+        self._lock = threading.RLock()
+        # NOTE: 書き込み中もget()が待たないように、ファイルやDBの読み書きは別のロックで守る
+        #       （_io_lockを持ったまま_lockを取らないこと）
+        self._io_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def _load(self) -> dict:
+        if self._data is not None:
+            # 書き込み中ならメモリ上の設定をそのまま使う（書き込み後に確認する）
+            if self._io_lock.acquire(blocking=False) is False:
+                return self._data
+            try:
+                version = self.backend.version()
+            finally:
+                self._io_lock.release()
+            if version == self._version:
+                return self._data
+        with self._io_lock:
+            version = self.backend.version()
+            data = self.backend.load()
+        # NOTE: まだ書き込んでいない変更は残す
+        if self._data is not None:
+            data.update(
+                {k: self._data[k] for k in self._dirty | self._saving})
+        self._data = data
+        self._version = version
+        return self._data
+
+    def get_all(self) -> dict:
+        with self._lock:
+            return deepcopy(self._load())
+
+    def get(self, key: str) -> dict:
+        '''設定を取得する。なければ初期設定を返す'''
+        with self._lock:
+            data = self._load()
+            # NOTE: 呼び出し元で書き換えられても影響がないようにコピーする
+            return deepcopy(data.get(key, data['default']))
+
+    def set(self, key: str, value: dict) -> None:
+        with self._lock:
+            self._load()[key] = deepcopy(value)
+            self._dirty.add(key)
+            if self._timer is None:
+                self._timer = threading.Timer(self.delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self) -> None:
+        '''変更を書き込む'''
+        # NOTE: 同じキーの古い値が後から書き込まれないように、書き込みは1つずつ行なう
+        with self._flush_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                if len(self._dirty) < 1:
+                    return
+                keys = self._dirty
+                self._dirty = set()
+                self._saving = keys
+                # NOTE: 値は丸ごと置き換えるだけなので浅いコピーでよい
+                data = dict(self._data)
+                version = self._version
+
+            # ロックの外で書き込む
+            try:
+                with self._io_lock:
+                    data, version = self.backend.save(data, keys, version)
+            except Exception:
+                # 次回もう一度書き込む
+                with self._lock:
+                    self._dirty |= keys
+                    self._saving = set()
+                raise
+
+            with self._lock:
+                self._saving = set()
+                # NOTE: 書き込み中に変更されたキーは残す
+                data.update({k: self._data[k] for k in self._dirty})
+                self._data = data
+                # NOTE: 他のプロセスが変更していた場合だけ次回読み直す
+                self._version = version
+
+
+def _create_store(name: str, path: Path) -> SettingStore:
+    conf = Config.get_global()
+    if conf.get('setting_backend', 'json') == 'sqlite':
+        backend = SqliteBackend(
+            SETTING_PATH / 'settings.sqlite3', name, source=path)
+    else:
+        backend = JsonBackend(path)
+    store = SettingStore(backend, conf.get('setting_flush_delay', 2.0))
+    atexit.register(store.flush)
+    return store
+
+
 class GuildSetting():
     GUILD_PATH = SETTING_PATH / "guild_setting.json"
+    _store = None
+
+    @classmethod
+    def get_store(cls) -> SettingStore:
+        if cls._store is None:
+            cls._store = _create_store('guild_setting', cls.GUILD_PATH)
+        return cls._store
 
     @classmethod
     def get_all_settings(cls) -> dict:
         '''全サーバーの設定を取得する'''
-        with cls.GUILD_PATH.open() as f:
-            return json.loads(f.read())
+        return cls.get_store().get_all()
 
     @classmethod
     def get_setting(cls, guild_id: int) -> dict:
         '''サーバー設定を取得する'''
-        data = cls.get_all_settings()
-        return data.get(str(guild_id), data['default'])
+        return cls.get_store().get(str(guild_id))
 
     @classmethod
     def update_setting(cls, guild_id: int, setting: dict) -> None:
         '''サーバー設定を保存する'''
-        data = cls.get_all_settings()
-        data[str(guild_id)] = setting
-        with cls.GUILD_PATH.open('w') as f:
-            f.write(json.dumps(data, ensure_ascii=True, indent=4))
+        cls.get_store().set(str(guild_id), setting)
+
+    @classmethod
+    def flush(cls) -> None:
+        '''未保存の変更を書き込む'''
+        if cls._store is not None:
+            cls._store.flush()
 
 
 class UserSetting():
     USER_PATH = "../lunalu-bot" / SETTING_PATH / "user_setting.json"
+    _store = None
+
+    @classmethod
+    def get_store(cls) -> SettingStore:
+        if cls._store is None:
+            cls._store = _create_store('user_setting', cls.USER_PATH)
+        return cls._store
 
     @classmethod
     def get_all_settings(cls) -> dict:
         '''全ユーザーの設定を取得する'''
-        with cls.USER_PATH.open() as f:
-            return json.loads(f.read())
+        return cls.get_store().get_all()
 
     @classmethod
     def get_setting(cls, user_id: int) -> dict:
         '''ユーザー設定を取得する'''
-        data = cls.get_all_settings()
         # NOTE: 初期設定をランダム化する場合は、ここでいい感じにする
-        return data.get(str(user_id), data['default'])
+        return cls.get_store().get(str(user_id))
 
     @classmethod
     def update(cls, user_id: int, setting: dict) -> None:
         '''ユーザー設定を保存する'''
-        data = cls.get_all_settings()
-        data[str(user_id)] = setting
-        with cls.USER_PATH.open('w') as f:
-            f.write(json.dumps(data, ensure_ascii=True, indent=4))
+        cls.get_store().set(str(user_id), setting)
+
+    @classmethod
+    def flush(cls) -> None:
+        '''未保存の変更を書き込む'''
+        if cls._store is not None:
+            cls._store.flush()